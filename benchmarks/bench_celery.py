@@ -0,0 +1,204 @@
+"""
+Drive the part-3 FastAPI + Celery path over HTTP and report requests/sec,
+p50/p99 request-to-result latency and the peak memory of the API and
+worker processes.
+
+The API and worker either run already (pass their PIDs with --pid to
+sample their memory), or are started by the benchmark with --start, from
+part-3/celery_lab and pointed at the stub upstreams. Either way they need
+the BROKER_* and ENGINE_* variables of a local RabbitMQ and Postgres.
+
+    uv run --project ../part-3/celery_lab python bench_celery.py --start --worker-profile io-bound
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from report import LatencyRecorder, MemorySampler, emit
+from stubs import add_stub_arguments, spawn_stub_server, stub_environment
+
+LOGGER = logging.getLogger(__name__)
+
+CELERY_LAB = Path(__file__).resolve().parent.parent / 'part-3' / 'celery_lab'
+
+READY_STATES = frozenset({'SUCCESS', 'FAILURE', 'REVOKED'})
+
+_local = threading.local()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--endpoint', choices=('weather', 'event'), default='weather')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per run')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent HTTP clients')
+    parser.add_argument('--rate', type=float, default=0, help='requests started per second, 0 for no limit')
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='number of distinct cities, 0 makes every city unique (no cache hits)')
+    parser.add_argument('--wait', type=float, default=10, help='the wait parameter sent to the API')
+    parser.add_argument('--priority', type=int, default=None)
+    parser.add_argument('--pid', type=int, action='append', default=[], help='a process to sample memory of')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the results')
+    parser.add_argument('--output', help='JSON Lines file the result is appended to')
+    parser.add_argument('--label', default='', help='describes the configuration under test in the report')
+
+    group = parser.add_argument_group('--start')
+    group.add_argument('--start', action='store_true', help='start the API and a worker from part-3/celery_lab')
+    group.add_argument('--stub-url', help='use a running stub server instead of starting one')
+    group.add_argument('--worker-profile', default='default', help='WORKER_PROFILE of the worker')
+    group.add_argument('--worker-concurrency', type=int, default=None, help='WORKER_CONCURRENCY of the worker')
+    group.add_argument('--worker-arg', action='append', default=[],
+                       help='extra celery worker option, e.g. --worker-arg=--pool=threads')
+    group.add_argument('--api-workers', type=int, default=1, help='uvicorn worker processes')
+    group.add_argument('--result-backend', choices=('database', 'rpc', 'redis'), default=None,
+                       help='TASK_RESULT_BACKEND of the API and worker, the lab setting by default')
+    group.add_argument('--result-backend-url', help='TASK_RESULT_BACKEND_URL, e.g. redis://localhost:6379/0')
+    group.add_argument('--broker-url', help='BROKER_URL, replaces the BROKER_* variables')
+    add_stub_arguments(parser)
+    return parser.parse_args()
+
+
+def describe(args):
+    config = [args.label] if args.label else []
+    if args.start:
+        config.append(f'profile={args.worker_profile}')
+        if args.worker_concurrency:
+            config.append(f'concurrency={args.worker_concurrency}')
+        config.extend(args.worker_arg)
+        config.append(f'api_workers={args.api_workers}')
+        if args.result_backend:
+            config.append(f'backend={args.result_backend}')
+    config.extend([f'clients={args.clients}', f'wait={args.wait:g}'])
+    return ' '.join(config)
+
+
+def get_session():
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def request_result(args, index, run_id, recorder, started):
+    """
+    Request one city and follow the task until it is ready.
+    """
+    if args.rate:
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    message_id = str(index)
+    city = f'city-{run_id}-{index % args.distinct if args.distinct else index}'
+    params = {'city': city, 'wait': args.wait}
+    if args.priority is not None:
+        params['priority'] = args.priority
+
+    recorder.sent(message_id)
+    try:
+        response = get_session().get(f'{args.api_url}/api/{args.endpoint}/', params=params)
+        response.raise_for_status()
+        status = response.json()
+        while status.get('status') not in READY_STATES:
+            response = get_session().get(f'{args.api_url}/api/task/{status["task_id"]}',
+                                         params={'wait': args.wait})
+            response.raise_for_status()
+            status = {'task_id': status['task_id'], **response.json()}
+    except Exception:
+        LOGGER.exception('Request %s failed', message_id)
+        recorder.done(message_id, ok=False)
+        return
+    recorder.done(message_id, ok=status['status'] == 'SUCCESS')
+
+
+def start_services(args, env):
+    """
+    Start uvicorn and a Celery worker consuming every queue of the lab.
+
+    :rtype: list[subprocess.Popen]
+    """
+    env = {**env, 'WORKER_PROFILE': args.worker_profile}
+    if args.worker_concurrency:
+        env['WORKER_CONCURRENCY'] = str(args.worker_concurrency)
+    if args.result_backend:
+        env['TASK_RESULT_BACKEND'] = args.result_backend
+    if args.result_backend_url:
+        env['TASK_RESULT_BACKEND_URL'] = args.result_backend_url
+    if args.broker_url:
+        env['BROKER_URL'] = args.broker_url
+
+    port = args.api_url.rsplit(':', 1)[-1].rstrip('/')
+    api = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', port,
+                            '--workers', str(args.api_workers), '--log-level', 'warning'],
+                           cwd=CELERY_LAB, env=env)
+    worker = subprocess.Popen([sys.executable, '-m', 'celery', '-A', 'app.celery.celery_app', 'worker',
+                               '-Q', 'celery,celery.weather,celery.event', '-l', 'WARNING', *args.worker_arg],
+                              cwd=CELERY_LAB, env=env)
+    return [api, worker]
+
+
+def wait_for_api(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/docs', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.5)
+    raise RuntimeError(f'The API did not come up on {url} within {timeout} seconds')
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stub_process = None
+    services = []
+    if args.start:
+        stub_url = args.stub_url
+        if stub_url is None:
+            stub_process, stub_url = spawn_stub_server(args)
+        env = {**os.environ, **stub_environment(stub_url), 'TICKETMASTER_RATE_LIMIT': '0'}
+        services = start_services(args, env)
+
+    try:
+        wait_for_api(args.api_url)
+        sampler = MemorySampler(args.pid + [service.pid for service in services]).start()
+
+        recorder = LatencyRecorder(args.requests)
+        run_id = int(time.time())
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            for index in range(args.requests):
+                executor.submit(request_result, args, index, run_id, recorder, started)
+            if not recorder.wait(args.timeout):
+                LOGGER.warning('Timed out after %.0f seconds, reporting the requests completed so far',
+                               args.timeout)
+                executor.shutdown(wait=False, cancel_futures=True)
+        peaks = sampler.stop()
+    finally:
+        for process in services:
+            process.send_signal(signal.SIGTERM)
+        for process in services:
+            process.wait()
+        if stub_process is not None:
+            stub_process.terminate()
+
+    emit({'scenario': f'celery-{args.endpoint}',
+          'config': describe(args),
+          **recorder.summary(),
+          'rss_mb': round(sum(peaks.values()), 1),
+          'rss_mb_per_process': peaks,
+          'params': vars(args)}, args.output)
+
+
+if __name__ == '__main__':
+    main()
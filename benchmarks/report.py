@@ -0,0 +1,201 @@
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def percentile(values, pct):
+    """
+    Get a percentile by the nearest-rank method.
+
+    :param list[float] values: The samples, sorted
+    :param float pct: The percentile, 0-100
+    :rtype: float
+    """
+    if not values:
+        return float('nan')
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident set size of this process, in MiB.
+
+    :rtype: float
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def process_tree_rss_mb(pid):
+    """
+    Get the current resident set size of a process and all of its
+    descendants, e.g. a Celery worker with its pool processes, in MiB.
+    Linux only.
+
+    :param int pid: The root process
+    :rtype: float
+    """
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total / 1024
+
+
+class MemorySampler:
+    def __init__(self, pids, interval=0.5):
+        """
+        Sample the resident memory of other processes (and their children)
+        in the background and remember the peak of each.
+
+        :param list[int] pids: The processes to sample
+        :param float interval: The seconds between samples
+        """
+        self._pids = list(pids)
+        self._interval = interval
+        self._peaks = {pid: 0.0 for pid in self._pids}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.__run, name='memory-sampler', daemon=True)
+
+    def start(self):
+        if self._pids:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :rtype: dict[int, float]
+        :return: The peak resident memory of each process tree, in MiB
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        return self._peaks
+
+    def __run(self):
+        while not self._stopped.is_set():
+            for pid in self._pids:
+                self._peaks[pid] = max(self._peaks[pid], process_tree_rss_mb(pid))
+            self._stopped.wait(self._interval)
+
+
+class LatencyRecorder:
+    def __init__(self, expected):
+        """
+        Collect the send and completion times of the messages of one run.
+
+        :param int expected: The number of messages that complete the run
+        """
+        self._expected = expected
+        self._sent = {}
+        self._latencies = []
+        self._failures = 0
+        self._first_sent = None
+        self._last_done = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def sent(self, message_id, at=None):
+        at = time.perf_counter() if at is None else at
+        with self._lock:
+            self._sent[message_id] = at
+            if self._first_sent is None:
+                self._first_sent = at
+
+    def done(self, message_id, ok=True, at=None):
+        at = time.perf_counter() if at is None else at
+        with self._lock:
+            sent = self._sent.pop(message_id, None)
+            if sent is None:
+                return
+            self._latencies.append(at - sent)
+            if not ok:
+                self._failures += 1
+            self._last_done = at
+            if len(self._latencies) >= self._expected:
+                self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until every expected message has completed.
+
+        :param float timeout: The maximum seconds to wait
+        :rtype: bool
+        """
+        return self._done.wait(timeout)
+
+    def summary(self):
+        """
+        Summarise the run.
+
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            completed = len(latencies)
+            elapsed = (self._last_done - self._first_sent) if completed else 0.0
+            return {
+                'sent': completed + len(self._sent),
+                'completed': completed,
+                'failed': self._failures,
+                'elapsed_s': round(elapsed, 3),
+                'msgs_per_s': round(completed / elapsed, 1) if elapsed else 0.0,
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'max_ms': round(latencies[-1] * 1000, 1) if latencies else float('nan'),
+            }
+
+
+COLUMNS = ('scenario', 'config', 'completed', 'failed', 'msgs_per_s', 'p50_ms', 'p99_ms', 'max_ms', 'rss_mb')
+
+
+def emit(result, output=None):
+    """
+    Print a result as one table row and append it to a JSON Lines file.
+
+    :param dict result: The result, with at least the keys in COLUMNS
+    :param str output: The JSON Lines file to append to, None to skip
+    """
+    row = [str(result.get(column, '')) for column in COLUMNS]
+    print('  '.join(f'{column}={value}' for column, value in zip(COLUMNS, row)), flush=True)
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+def print_table(path):
+    """
+    Print the results collected in a JSON Lines file side by side.
+
+    :param str path: The file written by emit()
+    """
+    with open(path, encoding='utf-8') as f:
+        results = [json.loads(line) for line in f if line.strip()]
+
+    rows = [COLUMNS] + [tuple(str(result.get(column, '')) for column in COLUMNS) for result in results]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(COLUMNS))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    print_table(sys.argv[1])
@@ -0,0 +1,252 @@
+import argparse
+import json
+import logging
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+WEATHER_PATH = '/v1/current.json'
+EVENTS_PATH = '/discovery/v2/events.json'
+
+API_KEYS = {
+    'weather-api-key': 'stub-weather-key',
+    'events-api-key': 'stub-events-key',
+    'event-api-key': 'stub-events-key',
+}
+
+
+class StubOptions:
+    def __init__(self, latency=0.0, jitter=0.0, payload_bytes=1024, error_rate=0.0, vault_latency=0.0,
+                 token_ttl=3600, rabbitmq_username='guest', rabbitmq_password='guest'):
+        """
+        How the stub upstreams behave.
+
+        :param float latency: The seconds every weather/events response is delayed
+        :param float jitter: Up to this many seconds are added to the latency at random
+        :param int payload_bytes: The approximate size of a weather/events response body
+        :param float error_rate: The share of weather/events requests answered with HTTP 503
+        :param float vault_latency: The seconds every Vault response is delayed
+        :param int token_ttl: The lease duration of the Vault client tokens, in seconds
+        :param str rabbitmq_username: The username served as the rabbitmq secret
+        :param str rabbitmq_password: The password served as the rabbitmq secret
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_bytes = payload_bytes
+        self.error_rate = error_rate
+        self.vault_latency = vault_latency
+        self.token_ttl = token_ttl
+        self.secrets = {
+            'apiKeys': API_KEYS,
+            'rabbitmq': {'username': rabbitmq_username, 'password': rabbitmq_password},
+        }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves WeatherAPI's current.json, Ticketmaster's events.json and the
+    Vault endpoints used by VaultHelper (AppRole login, token renewal and
+    KV v2 reads under the "secrets" mount) from one port.
+    """
+    protocol_version = 'HTTP/1.1'
+    options: StubOptions = None
+    counters: dict = None
+    counters_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == WEATHER_PATH:
+            self.__serve_upstream('weather', {'location': {'name': query.get('q')}, 'current': {'temp_c': 21.5}})
+        elif url.path == EVENTS_PATH:
+            self.__serve_upstream('events', {'_embedded': {'events': [{'name': f'Concert in {query.get("city")}'}]}})
+        elif url.path.startswith('/v1/secrets/data/'):
+            secret = self.options.secrets.get(url.path.rsplit('/', 1)[-1])
+            if secret is None:
+                self.__send(404, {'errors': []})
+            else:
+                self.__serve_vault({'data': {'data': secret}})
+        else:
+            self.__send(404, {'errors': [f'no stub for {url.path}']})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlsplit(self.path)
+
+        if url.path == '/v1/auth/approle/login':
+            self.__serve_vault({'auth': {'client_token': f'stub-token-{time.monotonic_ns()}',
+                                         'lease_duration': self.options.token_ttl, 'renewable': True}})
+        elif url.path == '/v1/auth/token/renew-self':
+            self.__serve_vault({'auth': {'client_token': self.headers.get('X-Vault-Token'),
+                                         'lease_duration': self.options.token_ttl, 'renewable': True}})
+        else:
+            self.__send(404, {'errors': [f'no stub for {url.path}']})
+
+    def __serve_upstream(self, name, body):
+        self.__count(name)
+        time.sleep(self.options.latency + random.uniform(0, self.options.jitter))
+        if random.random() < self.options.error_rate:
+            self.__send(503, {'error': 'stub failure'})
+            return
+
+        padding = self.options.payload_bytes - len(json.dumps({**body, 'padding': ''}))
+        if padding > 0:
+            body['padding'] = 'x' * padding
+        self.__send(200, body)
+
+    def __serve_vault(self, body):
+        self.__count('vault')
+        time.sleep(self.options.vault_latency)
+        self.__send(200, body)
+
+    def __count(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def __send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 refuses connections long before the
+    # consumers under test are saturated.
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=8300, options: StubOptions = None):
+        """
+        An HTTP server standing in for WeatherAPI, Ticketmaster and Vault,
+        one thread per connection.
+
+        :param str host: The address to listen on
+        :param int port: The port to listen on, 0 picks a free one
+        :param StubOptions options: How the stubs behave
+        """
+        handler = type('BoundStubHandler', (StubHandler,), {'options': options or StubOptions(), 'counters': {}})
+        super().__init__((host, port), handler)
+        self.counters = handler.counters
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Serve from a background thread.
+        """
+        threading.Thread(target=self.serve_forever, name='stub-server', daemon=True).start()
+        LOGGER.info('Serving stubs on %s', self.url)
+        return self
+
+
+def stub_environment(url):
+    """
+    Get the environment variables that point the part-2 consumers and the
+    part-3 Celery lab at a stub server.
+
+    :param str url: The base URL of the stub server
+    :rtype: dict[str, str]
+    """
+    return {
+        'VAULT_ADDR': url,
+        'VAULT_ROLE_ID': 'stub-role',
+        'VAULT_SECRET_ID': 'stub-secret',
+        'WEATHER_API_URL': f'{url}{WEATHER_PATH}',
+        'EVENTS_API_URL': f'{url}{EVENTS_PATH}',
+        'EVENT_API_URL': f'{url}{EVENTS_PATH}',
+    }
+
+
+def add_stub_arguments(parser):
+    group = parser.add_argument_group('stubs')
+    group.add_argument('--latency-ms', type=float, default=50, help='upstream response delay')
+    group.add_argument('--jitter-ms', type=float, default=0, help='random extra upstream delay')
+    group.add_argument('--payload-bytes', type=int, default=1024, help='upstream response size')
+    group.add_argument('--error-rate', type=float, default=0, help='share of upstream requests answered 503')
+    group.add_argument('--vault-latency-ms', type=float, default=5, help='Vault response delay')
+    group.add_argument('--rabbitmq-username', default='guest', help='username served by the Vault stub')
+    group.add_argument('--rabbitmq-password', default='guest', help='password served by the Vault stub')
+
+
+def stub_argv(args):
+    """
+    Get the command line options that reproduce the stub arguments of a
+    benchmark in a stub server process.
+
+    :param argparse.Namespace args: Parsed arguments, see add_stub_arguments
+    :rtype: list[str]
+    """
+    return ['--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+            '--payload-bytes', str(args.payload_bytes), '--error-rate', str(args.error_rate),
+            '--vault-latency-ms', str(args.vault_latency_ms),
+            '--rabbitmq-username', args.rabbitmq_username, '--rabbitmq-password', args.rabbitmq_password]
+
+
+def spawn_stub_server(args):
+    """
+    Run a stub server in a child process on a free port, so it does not
+    compete with the code under test for the GIL or count towards its memory.
+
+    :param argparse.Namespace args: Parsed arguments, see add_stub_arguments
+    :rtype: tuple[subprocess.Popen, str]
+    :return: The process and the base URL of the stub server
+    """
+    process = subprocess.Popen([sys.executable, __file__, '--port', '0', *stub_argv(args)],
+                               stdout=subprocess.PIPE, text=True)
+    for line in process.stdout:
+        if line.startswith('export VAULT_ADDR='):
+            return process, line.strip().split('=', 1)[1]
+    process.wait()
+    raise RuntimeError(f'Stub server exited with code {process.returncode}')
+
+
+def stub_options_from_args(args):
+    return StubOptions(latency=args.latency_ms / 1000,
+                       jitter=args.jitter_ms / 1000,
+                       payload_bytes=args.payload_bytes,
+                       error_rate=args.error_rate,
+                       vault_latency=args.vault_latency_ms / 1000,
+                       rabbitmq_username=args.rabbitmq_username,
+                       rabbitmq_password=args.rabbitmq_password)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stub WeatherAPI, Ticketmaster and Vault endpoints.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8300)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    server = StubServer(args.host, args.port, stub_options_from_args(args))
+    for name, value in stub_environment(server.url).items():
+        print(f'export {name}={value}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        LOGGER.info('Requests served: %s', server.counters)
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,137 @@
+import argparse
+import math
+import time
+
 import pika
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+SENT_AT_HEADER = 'x-sent-at'
+
 
 def callback(ch, method, properties, body):
     print(f" [x] Received {body}")
 
 
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+class LatencyHistogram:
+    def __init__(self, lowest=0.01, highest=3_600_000.0, buckets_per_decade=100):
+        """
+        Count latencies in milliseconds in fixed, log-spaced buckets, so a
+        run of any length keeps the same memory. Percentiles are the upper
+        bound of their bucket, within 2.3% of the exact value at the default
+        100 buckets per decade; values outside lowest..highest are clamped.
+        """
+        self._lowest = lowest
+        self._per_decade = buckets_per_decade
+        self._counts = [0] * (self._index(highest) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def _index(self, value):
+        if value <= self._lowest:
+            return 0
+        return math.ceil(math.log10(value / self._lowest) * self._per_decade)
+
+    def add(self, value):
+        self._counts[min(self._index(value), len(self._counts) - 1)] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, pct):
+        """Nearest-rank percentile, as the upper bound of its bucket."""
+        rank = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank and index < len(self._counts) - 1:
+                return min(self._lowest * 10 ** (index / self._per_decade), self.max)
+        return self.max
+
+
+class LatencyStats:
+    def __init__(self, connection, interval):
+        """
+        Measure the end-to-end latency of each message from the send
+        timestamp header set by the producer, and print throughput and
+        latency percentiles every interval seconds instead of the bodies.
+
+        The producer and the consumer must share a clock, e.g. run on the
+        same host.
+        """
+        self._connection = connection
+        self._interval = interval
+        self._window = []
+        self._window_count = 0
+        self._window_started = time.perf_counter()
+        self._total = 0
+        self._total_latencies = LatencyHistogram()
+        self._started = None
+        self._last = None
+        self._connection.call_later(self._interval, self.report)
+
+    def callback(self, ch, method, properties, body):
+        if self._started is None:
+            self._started = time.perf_counter()
+        self._last = time.perf_counter()
+        self._window_count += 1
+        sent_at = (properties.headers or {}).get(SENT_AT_HEADER)
+        if sent_at is not None:
+            self._window.append((time.time_ns() - sent_at) / 1e6)
+
+    def report(self):
+        now = time.perf_counter()
+        elapsed = now - self._window_started
+        if self._window_count:
+            line = f" [=] {self._window_count / elapsed:8.0f} msg/s"
+            if self._window:
+                latencies = sorted(self._window)
+                line += (f"  latency ms p50 {percentile(latencies, 50):7.2f}  p95 {percentile(latencies, 95):7.2f}"
+                         f"  p99 {percentile(latencies, 99):7.2f}  max {latencies[-1]:7.2f}")
+            print(line, flush=True)
+
+        self._total += self._window_count
+        for latency in self._window:
+            self._total_latencies.add(latency)
+        self._window = []
+        self._window_count = 0
+        self._window_started = now
+        self._connection.call_later(self._interval, self.report)
+
+    def summary(self):
+        self._total += self._window_count
+        for latency in self._window:
+            self._total_latencies.add(latency)
+        if not self._total:
+            return
+        elapsed = max(self._last - self._started, 1e-9)
+        line = f" [=] total {self._total} messages in {elapsed:.2f}s ({self._total / elapsed:.0f} msg/s)"
+        latencies = self._total_latencies
+        if latencies.count:
+            line += (f", latency ms p50 {latencies.percentile(50):.2f} p99 {latencies.percentile(99):.2f}"
+                     f" max {latencies.max:.2f}")
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Consume the hello queue.')
+    parser.add_argument('--queue', default='hello')
+    parser.add_argument('--stats', type=float, nargs='?', const=1.0, default=None, metavar='SECONDS',
+                        help='print throughput and end-to-end latency every SECONDS (default 1) '
+                             'instead of each message')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='prefetch count; 0 keeps auto-ack with no limit')
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     credentials = pika.PlainCredentials(
         username=os.getenv('username'),
         password=os.getenv("password")
@@ -23,13 +145,36 @@ def main():
 
     channel = connection.channel()
 
-    channel.queue_declare(queue='hello')
-    channel.basic_consume(queue='hello',
-                          on_message_callback=callback,
-                          auto_ack=True)
+    channel.queue_declare(queue=args.queue)
+
+    stats = None
+    on_message = callback
+    if args.stats is not None:
+        stats = LatencyStats(connection, args.stats)
+        on_message = stats.callback
+
+    if args.prefetch:
+        channel.basic_qos(prefetch_count=args.prefetch)
+
+        def on_message_ack(ch, method, properties, body, handler=on_message):
+            handler(ch, method, properties, body)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        channel.basic_consume(queue=args.queue, on_message_callback=on_message_ack)
+    else:
+        channel.basic_consume(queue=args.queue,
+                              on_message_callback=on_message,
+                              auto_ack=True)
 
     print(' [*] Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        channel.stop_consuming()
+    finally:
+        if stats is not None:
+            stats.summary()
+        connection.close()
 
 
 if __name__ == "__main__":
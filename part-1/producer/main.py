@@ -1,26 +1,130 @@
+import argparse
+import itertools
+import threading
+import time
+
 import pika
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-if __name__ == '__main__':
+SENT_AT_HEADER = 'x-sent-at'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Publish to the hello queue. Without options a single "Hello World!" is sent; '
+                    'with --count or --duration the producer becomes a load generator.')
+    parser.add_argument('--queue', default='hello')
+    parser.add_argument('--count', type=int, default=None, help='total messages to send')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to send for')
+    parser.add_argument('--rate', type=float, default=0, help='target messages per second in total, 0 for no limit')
+    parser.add_argument('--size', type=int, default=0, help='message body size in bytes, 0 for "Hello World!"')
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--channels', type=int, default=1, help='channels per connection')
+    parser.add_argument('--confirms', action='store_true',
+                        help='wait for a publisher confirm after every message')
+    return parser.parse_args()
+
+
+def connect():
     credentials = pika.PlainCredentials(
         username=os.getenv('username'),
         password=os.getenv('password')
     )
-    connection = pika.BlockingConnection(
+    return pika.BlockingConnection(
         pika.ConnectionParameters(
             host='localhost',
             credentials=credentials
         )
     )
-    channel = connection.channel()
 
-    channel.queue_declare(queue='hello')
 
-    channel.basic_publish(exchange='',
-                          routing_key='hello',
-                          body='Hello World!')
-    print(" [x] Sent 'Hello World!'")
-    connection.close()
\ No newline at end of file
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+
+def publish_loop(args, body, count, rate, deadline, stats):
+    """
+    Publish from one connection, round-robin over its channels.
+
+    Messages are sent on a fixed schedule (open loop), so a slow broker
+    shows up as latency on the consumer instead of a lower send rate.
+    """
+    connection = connect()
+    channels = []
+    for _ in range(args.channels):
+        channel = connection.channel()
+        channel.queue_declare(queue=args.queue)
+        if args.confirms:
+            channel.confirm_delivery()
+        channels.append(channel)
+
+    interval = 1 / rate if rate else 0
+    started = time.perf_counter()
+    sent = rejected = 0
+    for index, channel in zip(itertools.count() if count is None else range(count), itertools.cycle(channels)):
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        properties = pika.BasicProperties(headers={SENT_AT_HEADER: time.time_ns()})
+        try:
+            channel.basic_publish(exchange='', routing_key=args.queue, body=body, properties=properties)
+        except (pika.exceptions.NackError, pika.exceptions.UnroutableError):
+            rejected += 1
+        sent += 1
+
+    connection.close()
+    with stats.lock:
+        stats.sent += sent
+        stats.rejected += rejected
+
+
+def run_load(args):
+    body = b'x' * args.size if args.size else b'Hello World!'
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    counts = [None] * args.connections
+    if args.count is not None:
+        counts = [args.count // args.connections + (index < args.count % args.connections)
+                  for index in range(args.connections)]
+
+    stats = Stats()
+    threads = [threading.Thread(target=publish_loop,
+                                args=(args, body, count, args.rate / args.connections, deadline, stats))
+               for count in counts]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f" [x] Sent {stats.sent} messages of {len(body)} bytes in {elapsed:.2f}s "
+          f"({stats.sent / elapsed:.0f} msg/s) over {args.connections} connection(s) "
+          f"x {args.channels} channel(s)" + (f", {stats.rejected} rejected" if args.confirms else ''))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.count is not None or args.duration is not None:
+        run_load(args)
+    else:
+        connection = connect()
+        channel = connection.channel()
+
+        channel.queue_declare(queue=args.queue)
+
+        channel.basic_publish(exchange='',
+                              routing_key=args.queue,
+                              body='Hello World!',
+                              properties=pika.BasicProperties(headers={SENT_AT_HEADER: time.time_ns()}))
+        print(" [x] Sent 'Hello World!'")
+        connection.close()
@@ -0,0 +1,282 @@
+from abc import ABC, abstractmethod
+import asyncio
+import functools
+import json
+import logging
+import time
+import uuid
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from broker_connection import RabbitMqConnection
+from concumers import EVENTS_API_URL, WEATHER_API_URL, BaseConsumer
+from http_client import get_async_client
+from metrics import CONSUMER_MESSAGES, CONSUMER_STAGE_SECONDS, RABBITMQ_RECONNECTS
+from publisher import TaskPublisher
+from resilience import CircuitOpenError, aguarded_request
+from result_sinks import ResultSink, get_default_sink
+from vault_helper import VaultHelper
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+
+
+class AsyncioRabbitMqConnection(RabbitMqConnection):
+    """
+    RabbitMqConnection running on an asyncio event loop instead of pika's
+    SelectConnection IOLoop.
+
+    Channels, recovery callbacks, flow control and reconnect backoff are
+    inherited unchanged, so BaseConsumer, TaskPublisher and
+    RabbitMQInitializer work on it as they are; handlers running on the
+    loop can additionally await coroutines.
+    """
+
+    def __init__(self, amqp_url, on_ready_callback, reconnect_delay=1.0, max_reconnect_delay=30.0):
+        super().__init__(amqp_url, on_ready_callback, reconnect_delay, max_reconnect_delay)
+        self._loop = None
+        self._disconnected = None
+
+    def connect(self):
+        """
+        Establish a connection to RabbitMQ on the running event loop.
+
+        :rtype: pika.adapters.asyncio_connection.AsyncioConnection
+        :return: The connection handle
+        """
+        LOGGER.info('Connecting to %s', self.amqp_url)
+        connection = AsyncioConnection(
+            pika.URLParameters(self.amqp_url),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self._loop)
+        connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+        return connection
+
+    def add_callback_threadsafe(self, callback):
+        """Schedule the callback to run on the event loop from any thread.
+
+        :param callable callback: The callback to run on the event loop
+        """
+        self._loop.call_soon_threadsafe(callback)
+
+    def _stop_ioloop(self):
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
+    async def run(self):
+        """Connect and stay connected until stop() is called.
+
+        Reconnects with backoff whenever the connection fails or is lost.
+        """
+        self._loop = asyncio.get_running_loop()
+        while True:
+            self._disconnected = self._loop.create_future()
+            self._connection = self.connect()
+            await self._disconnected
+            if self._stopping:
+                break
+
+            delay = self._next_reconnect_delay()
+            LOGGER.info('Reconnecting in %.1f seconds', delay)
+            await asyncio.sleep(delay)
+            if self._stopping:
+                break
+            self._reconnect_count += 1
+            RABBITMQ_RECONNECTS.inc()
+
+
+class AsyncTaskPublisher(TaskPublisher):
+    """
+    TaskPublisher for an AsyncioRabbitMqConnection, with awaitable confirms.
+    """
+
+    async def apublish_many(self, tasks):
+        """
+        Publish many tasks and wait for RabbitMQ to confirm them.
+
+        Must be called on the connection's event loop.
+
+        :param iterable tasks: The tasks to publish, see publish_many
+        :raises PublisherBackpressureError: If the outbound queue has no room
+        :return: True for each confirmed task, False for each rejected one
+        :rtype: list[bool]
+        """
+        futures = self.publish_many(tasks)
+        return list(await asyncio.gather(*(asyncio.wrap_future(future) for future in futures)))
+
+
+class AsyncApiConsumer(BaseConsumer, ABC):
+    upstream = None
+
+    def __init__(self, connection: AsyncioRabbitMqConnection, queue_name, vault_helper: VaultHelper, api_key,
+                 concurrency=100, prefetch_count=None, dedicated_channel=False,
+                 result_sink: ResultSink = None):
+        """
+        The asyncio counterpart of ApiConsumer: each delivery is handled by a
+        task on the event loop, so one process keeps up to `concurrency`
+        upstream requests in flight without a thread per request.
+
+        :param connection: AsyncioRabbitMqConnection
+            The RabbitMQ connection object.
+        :param queue_name: str
+            The name of the queue to consume from.
+        :param vault_helper: VaultHelper
+            The Vault helper object.
+        :param api_key: str
+            The API key to fetch from Vault.
+        :param concurrency: int
+            The maximum number of messages processed at once.
+        :param prefetch_count: int | None
+            Overrides the prefetch count, which defaults to the concurrency.
+        :param dedicated_channel: bool
+            Consume on a channel of its own, see BaseConsumer.
+        :param result_sink: ResultSink | None
+            Where results are saved, defaults to the process-wide sink.
+        """
+        super().__init__(connection, queue_name,
+                         prefetch_count=prefetch_count or concurrency,
+                         dedicated_channel=dedicated_channel)
+        self._vault_helper = vault_helper
+        self._api_key = api_key
+        self._result_sink = result_sink or get_default_sink()
+        self._result_name = self.__class__.__name__.lower().replace('async', '').replace('consumer', '')
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    def on_message(self, channel, basic_deliver, properties, body):
+        LOGGER.info('Received message # %s from %s: %s',
+                    basic_deliver.delivery_tag, properties.app_id, body)
+
+        task = asyncio.ensure_future(self.__handle_message(channel, basic_deliver.delivery_tag, properties, body,
+                                                           time.perf_counter()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def __handle_message(self, channel, delivery_tag, properties, body, received_at):
+        """
+        Process the message and settle it on the channel it came from.
+        """
+        async with self._semaphore:
+            CONSUMER_STAGE_SECONDS.labels(self._result_name, 'queue').observe(time.perf_counter() - received_at)
+            try:
+                await self.process_message(properties, body)
+            except CircuitOpenError as e:
+                LOGGER.warning('Holding message %s for %.1f seconds: %s', delivery_tag, e.retry_after, e)
+                self._connection.call_later(e.retry_after, functools.partial(
+                    self.__settle_message, channel, delivery_tag, ack=False, requeue=True))
+                return
+            except Exception:
+                LOGGER.exception('Failed to process message %s', delivery_tag)
+                self.__settle_message(channel, delivery_tag, ack=False)
+                return
+        self.__settle_message(channel, delivery_tag, ack=True)
+
+    def __settle_message(self, channel, delivery_tag, ack, requeue=False):
+        if not channel.is_open:
+            LOGGER.warning('Channel closed before message %s was settled', delivery_tag)
+            return
+        if ack:
+            LOGGER.info('Acknowledging message %s', delivery_tag)
+            with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'ack').time():
+                channel.basic_ack(delivery_tag)
+        else:
+            LOGGER.warning('Rejecting message %s', delivery_tag)
+            channel.basic_nack(delivery_tag, requeue=requeue)
+        CONSUMER_MESSAGES.labels(self._result_name, 'ack' if ack else 'requeue' if requeue else 'nack').inc()
+
+    async def process_message(self, properties, body):
+        """
+        Fetch the API key, call the upstream API through its rate limiter
+        and circuit breaker, and save the response.
+
+        :param pika.spec.BasicProperties properties: The message properties
+        :param bytes body: The message body
+        """
+        json_data = json.loads(body)
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'vault').time():
+            api_key = await self._vault_helper.aget_api_key(alias=self._api_key)
+
+        LOGGER.info('Json data for %s: %s', self.__class__.__name__, json_data)
+
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'upstream').time():
+            response = await aguarded_request(self.upstream, lambda: self.make_api_request(api_key, json_data))
+        self.save_response(response, task_id=properties.message_id or uuid.uuid4().hex)
+
+    def on_cancelok(self, _unused_frame, userdata):
+        """Cancel the messages still being processed before the channel is
+        closed; RabbitMQ requeues them once the channel goes away.
+        """
+        for task in self._tasks:
+            task.cancel()
+        super().on_cancelok(_unused_frame, userdata)
+
+    @abstractmethod
+    async def make_api_request(self, api_key: str, json_data: dict):
+        pass
+
+    def save_response(self, response, task_id):
+        """
+        Hand the response to the result sink, in the same record shape as
+        ApiConsumer.
+
+        :param httpx.Response response: The response from the API
+        :param str task_id: The ID the result is stored under
+        """
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'save').time():
+            result = response.json()
+            LOGGER.debug('Response: %s', result)
+
+            self._result_sink.write(self._result_name, {
+                'task_id': task_id,
+                'status': 'SUCCESS' if response.is_success else 'FAILURE',
+                'result': result,
+                'error': None if response.is_success else f'HTTP {response.status_code}',
+            })
+
+
+class AsyncWeatherConsumer(AsyncApiConsumer):
+    upstream = 'weatherapi'
+
+    async def make_api_request(self, api_key: str, json_data: dict):
+        """
+        Make an API request to WeatherAPI.
+
+        :param str api_key: The API key to use for the request
+        :param dict json_data: The JSON data to use for the request
+        :return: The response from the API
+        :rtype: httpx.Response
+        """
+        return await get_async_client().get(
+            url=WEATHER_API_URL,
+            params={
+                'key': api_key,
+                'q': json_data.get('q')
+            }
+        )
+
+
+class AsyncEventConsumer(AsyncApiConsumer):
+    upstream = 'ticketmaster'
+
+    async def make_api_request(self, api_key: str, json_data: dict):
+        """
+        Make a GET request to the Ticketmaster API to retrieve events for a given city.
+
+        :param str api_key: The API key to use for the request
+        :param dict json_data: The JSON data to use for the request
+        :return: The response from the API
+        :rtype: httpx.Response
+        """
+        return await get_async_client().get(
+            url=EVENTS_API_URL,
+            params={
+                'apikey': api_key,
+                'city': json_data.get('city')
+            }
+        )
@@ -1,5 +1,9 @@
 import logging
+import random
+import time
 import pika
+from metrics import (RABBITMQ_BLOCKED_CONNECTIONS, RABBITMQ_BLOCKED_SECONDS, RABBITMQ_CHANNEL_RECOVERIES,
+                     RABBITMQ_RECONNECTS)
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -8,18 +12,31 @@ logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 
 
 class RabbitMqConnection:
-    def __init__(self, amqp_url, on_ready_callback):
+    def __init__(self, amqp_url, on_ready_callback, reconnect_delay=1.0, max_reconnect_delay=30.0):
         """
         Initialize the RabbitMqConnection object.
 
         :param str amqp_url: The AMQP URL used to connect to RabbitMQ
+        :param callable on_ready_callback: Called once, the first time the
+            connection and its channel are open
+        :param float reconnect_delay: The base delay before reconnecting, in seconds
+        :param float max_reconnect_delay: The upper bound of the reconnect delay, in seconds
         """
         self.amqp_url = amqp_url
         self._connection = None
         self._channel = None
         self._stopping = False
         self._ready = False
+        self._was_ready = False
         self._on_ready_callback = on_ready_callback
+        self._recovery_callbacks = []
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._reconnect_attempts = 0
+        self._reconnect_count = 0
+        self._blocked_since = None
+        self._blocked_seconds = 0.0
+        self._flow_control_callbacks = []
 
     def connect(self):
         """
@@ -29,11 +46,14 @@ class RabbitMqConnection:
         :return: The connection handle
         """
         LOGGER.info('Connecting to %s', self.amqp_url)
-        return pika.SelectConnection(
+        connection = pika.SelectConnection(
             pika.URLParameters(self.amqp_url),
             on_open_callback=self.on_connection_open,
             on_open_error_callback=self.on_connection_open_error,
-            on_close_callback=self.close)
+            on_close_callback=self.on_connection_closed)
+        connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+        return connection
 
     def on_connection_open(self, _unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
@@ -43,6 +63,7 @@ class RabbitMqConnection:
         :param pika.SelectConnection _unused_connection: The connection
         """
         LOGGER.info('Connection opened')
+        self._reconnect_attempts = 0
         self.open_channel()
 
     def on_connection_open_error(self, _unused_connection, err):
@@ -52,8 +73,72 @@ class RabbitMqConnection:
         :param pika.SelectConnection _unused_connection: The connection
         :param Exception err: The error
         """
-        LOGGER.error('Connection open failed, reopening in 5 seconds: %s', err)
-        self._connection.ioloop.call_later(5, self._connection.ioloop.stop)
+        LOGGER.error('Connection open failed: %s', err)
+        self._stop_ioloop()
+
+    def on_connection_closed(self, _unused_connection, reason):
+        """This method is invoked by pika when the connection to RabbitMQ is
+        closed. Unless we are stopping, the IOLoop is stopped so run() can
+        reconnect after a backoff.
+
+        :param pika.SelectConnection _unused_connection: The closed connection
+        :param Exception reason: The reason the connection was closed
+        """
+        self._channel = None
+        self._ready = False
+        self._end_block()
+
+        if self._stopping:
+            LOGGER.info('Connection closed')
+        else:
+            LOGGER.warning('Connection closed, reconnect necessary: %s', reason)
+        self._stop_ioloop()
+
+    def on_connection_blocked(self, _unused_connection, method_frame):
+        """This method is called by pika when RabbitMQ blocks publishing on
+        the connection, e.g. because of a memory or disk alarm. Publishers
+        registered through add_on_flow_control_callback are told to pause.
+
+        :param pika.SelectConnection _unused_connection: The connection
+        :param pika.frame.Method method_frame: The Connection.Blocked frame
+        """
+        LOGGER.warning('Connection blocked by RabbitMQ: %s', method_frame.method.reason)
+        if self._blocked_since is None:
+            self._blocked_since = time.monotonic()
+            RABBITMQ_BLOCKED_CONNECTIONS.inc()
+        self._notify_flow_control(blocked=True)
+
+    def on_connection_unblocked(self, _unused_connection, _unused_frame):
+        """This method is called by pika when RabbitMQ lifts the block on the
+        connection. Publishers are told to resume.
+
+        :param pika.SelectConnection _unused_connection: The connection
+        :param pika.frame.Method _unused_frame: The Connection.Unblocked frame
+        """
+        self._end_block()
+        LOGGER.info('Connection unblocked, %.1f seconds blocked in total', self._blocked_seconds)
+        self._notify_flow_control(blocked=False)
+
+    def _end_block(self):
+        if self._blocked_since is None:
+            return
+        blocked = time.monotonic() - self._blocked_since
+        self._blocked_seconds += blocked
+        self._blocked_since = None
+        RABBITMQ_BLOCKED_SECONDS.inc(blocked)
+        RABBITMQ_BLOCKED_CONNECTIONS.dec()
+
+    def add_on_flow_control_callback(self, callback):
+        """Register a callback invoked with blocked=True or blocked=False
+        whenever RabbitMQ blocks or unblocks the connection.
+
+        :param callable callback: The callback
+        """
+        self._flow_control_callbacks.append(callback)
+
+    def _notify_flow_control(self, blocked):
+        for callback in self._flow_control_callbacks:
+            callback(blocked=blocked)
 
     def open_channel(self):
         """This method will open a new channel with RabbitMQ by issuing the
@@ -64,6 +149,16 @@ class RabbitMqConnection:
         LOGGER.info('Creating a new channel')
         self._connection.channel(on_open_callback=self.on_channel_open)
 
+    def open_extra_channel(self, on_open_callback):
+        """Open an additional channel on the connection, e.g. for a consumer
+        that should not share the default channel. The caller owns the
+        channel and its recovery.
+
+        :param callable on_open_callback: Called with the channel once it is open
+        """
+        LOGGER.info('Creating an extra channel')
+        self._connection.channel(on_open_callback=on_open_callback)
+
     def on_channel_open(self, channel):
         """This method is invoked by pika when the channel has been opened.
         The channel object is passed in so we can make use of it.
@@ -78,10 +173,28 @@ class RabbitMqConnection:
         self._ready = True
         self.add_on_channel_close_callback()
 
+        if self._was_ready:
+            RABBITMQ_CHANNEL_RECOVERIES.inc()
+            LOGGER.info('Calling %i recovery callbacks', len(self._recovery_callbacks))
+            for callback in self._recovery_callbacks:
+                callback()
+            return
+
+        self._was_ready = True
         if self._on_ready_callback:
             LOGGER.info('Calling ready callback')
             self._on_ready_callback(self)
 
+    def add_on_recovery_callback(self, callback):
+        """Register a callback invoked, in registration order, every time the
+        channel is open again after a channel or connection failure. Topology
+        declarations, publishers and consumers use it to restore themselves
+        on the new channel.
+
+        :param callable callback: The callback
+        """
+        self._recovery_callbacks.append(callback)
+
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
         RabbitMQ unexpectedly closes the channel.
@@ -93,16 +206,17 @@ class RabbitMqConnection:
         """Invoked by pika when RabbitMQ unexpectedly closes the channel.
         Channels are usually closed if you attempt to do something that
         violates the protocol, such as re-declare an exchange or queue with
-        different parameters. In this case, we'll close the connection
-        to shutdown the object.
+        different parameters. Unless we are stopping or the whole connection
+        is going away, a new channel is opened after the reconnect delay.
 
         :param pika.channel.Channel channel: The closed channel
         :param Exception reason: why the channel was closed
         """
         LOGGER.warning('Channel %i was closed: %s', channel, reason)
         self._channel = None
-        if not self._stopping:
-            self._connection.close()
+        self._ready = False
+        if not self._stopping and self.is_connect():
+            self._connection.ioloop.call_later(self._reconnect_delay, self.open_channel)
 
     @property
     def channel(self):
@@ -110,16 +224,58 @@ class RabbitMqConnection:
             raise RuntimeError("Connection not ready")
         return self._channel
 
+    @property
+    def blocked(self):
+        """Whether RabbitMQ currently blocks publishing on the connection."""
+        return self._blocked_since is not None
+
+    @property
+    def blocked_seconds(self):
+        """Total time publishing has been blocked by RabbitMQ, in seconds."""
+        if self._blocked_since is None:
+            return self._blocked_seconds
+        return self._blocked_seconds + time.monotonic() - self._blocked_since
+
+    @property
+    def reconnect_count(self):
+        """The number of times the connection has been re-established."""
+        return self._reconnect_count
+
     @property
     def ready(self):
         return self._ready and self._channel and self._channel.is_open
 
     def close(self):
         """This method closes the connection to RabbitMQ."""
-        if self._connection is not None:
+        if self._connection is not None and not (self._connection.is_closing or self._connection.is_closed):
             LOGGER.info('Closing connection')
             self._connection.close()
 
+    def stop(self):
+        """Close the connection for good: run() returns instead of reconnecting."""
+        self._stopping = True
+        if self.is_connect():
+            self.close()
+        elif self._connection is not None:
+            self._stop_ioloop()
+
+    def add_callback_threadsafe(self, callback):
+        """Schedule the callback to run on the IOLoop thread. This is the only
+        safe way to interact with the connection or its channels from another
+        thread, e.g. to acknowledge a message processed by a worker pool.
+
+        :param callable callback: The callback to run on the IOLoop thread
+        """
+        self._connection.ioloop.add_callback_threadsafe(callback)
+
+    def call_later(self, delay, callback):
+        """Schedule the callback to run on the IOLoop thread after a delay.
+
+        :param float delay: The delay in seconds
+        :param callable callback: The callback
+        """
+        self._connection.ioloop.call_later(delay, callback)
+
     def is_connect(self):
         """
         Check if the connection to RabbitMQ is established.
@@ -128,7 +284,35 @@ class RabbitMqConnection:
         """
         return self._connection and self._connection.is_open
 
+    def _stop_ioloop(self):
+        """Stop the IOLoop, which makes run() reconnect or return."""
+        self._connection.ioloop.stop()
+
+    def _next_reconnect_delay(self):
+        """
+        Exponential backoff with full jitter: a random delay between zero and
+        reconnect_delay * 2 ** attempts, capped at max_reconnect_delay.
+
+        :rtype: float
+        """
+        cap = min(self._max_reconnect_delay, self._reconnect_delay * 2 ** self._reconnect_attempts)
+        self._reconnect_attempts += 1
+        return random.uniform(0, cap)
+
     def run(self):
-        """Запуск IOLoop"""
-        self._connection = self.connect()
-        self._connection.ioloop.start()
+        """Запуск IOLoop
+
+        Reconnects with backoff whenever the connection fails or is lost,
+        until stop() is called.
+        """
+        while True:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+            if self._stopping:
+                break
+
+            delay = self._next_reconnect_delay()
+            LOGGER.info('Reconnecting in %.1f seconds', delay)
+            time.sleep(delay)
+            self._reconnect_count += 1
+            RABBITMQ_RECONNECTS.inc()
@@ -1,33 +1,73 @@
 from abc import ABC, abstractmethod
 import logging
 import functools
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from broker_connection import RabbitMqConnection
+from http_client import get_session
 from vault_helper import VaultHelper
+from metrics import CONSUMER_MESSAGES, CONSUMER_STAGE_SECONDS
+from result_sinks import ResultSink, get_default_sink
+from resilience import CircuitOpenError, guarded_request
 import json
+import os
 import requests
-from pathlib import Path
+import uuid
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 
+WEATHER_API_URL = os.getenv('WEATHER_API_URL', 'http://api.weatherapi.com/v1/current.json')
+EVENTS_API_URL = os.getenv('EVENTS_API_URL', 'https://app.ticketmaster.com/discovery/v2/events.json')
+
 
 class BaseConsumer(ABC):
-    def __init__(self, connection: RabbitMqConnection, queue_name):
+    def __init__(self, connection: RabbitMqConnection, queue_name, prefetch_count=1, dedicated_channel=False):
+        """
+        Initialize the BaseConsumer instance.
+
+        :param connection: RabbitMqConnection
+            The RabbitMQ connection object.
+        :param queue_name: str
+            The name of the queue to consume from.
+        :param prefetch_count: int
+            The maximum number of unacknowledged messages RabbitMQ delivers
+            to this consumer.
+        :param dedicated_channel: bool
+            Consume on a channel of its own instead of the connection's
+            shared channel, so the consumer's flow and prefetch do not
+            interfere with other consumers.
+        """
         self._connection = connection
-        self._channel = connection.channel
+        self._dedicated_channel = dedicated_channel
+        self._channel = None if dedicated_channel else connection.channel
         self._consuming = False
         self._consumer_tag = None
         self._queue_name = queue_name
+        self._prefetch_count = prefetch_count
+        self._started = False
+        self._stopped = False
+        self._connection.add_on_recovery_callback(self.on_connection_recovered)
 
     def start_consuming(self):
         if not self._connection.ready:
             raise RuntimeError("RabbitMQ connection is not ready")
 
+        self._started = True
+        if self._dedicated_channel:
+            LOGGER.info('Opening a dedicated channel for queue: %s', self._queue_name)
+            self._connection.open_extra_channel(self.on_channel_open)
+        else:
+            self._channel = self._connection.channel
+            self.consume()
+
+    def consume(self):
         LOGGER.info('Starting consumer for queue: %s', self._queue_name)
 
-        self._channel.basic_qos(prefetch_count=1)
+        self._channel.basic_qos(prefetch_count=self._prefetch_count)
         self._consumer_tag = self._channel.basic_consume(
             self._queue_name,
             self.on_message,
@@ -38,6 +78,44 @@ class BaseConsumer(ABC):
 
         LOGGER.info('Consumer started with tag: %s', self._consumer_tag)
 
+    def on_channel_open(self, channel):
+        """Invoked by pika when the dedicated channel has been opened.
+
+        :param pika.channel.Channel channel: The channel object
+        """
+        self._channel = channel
+        self._channel.add_on_close_callback(self.on_channel_closed)
+        self.consume()
+
+    def on_channel_closed(self, channel, reason):
+        """Invoked by pika when the dedicated channel is closed. If the
+        connection is still up and the consumer was not stopped, a new
+        channel is opened after a short delay; if the whole connection went
+        away, on_connection_recovered takes over once it is back.
+
+        :param pika.channel.Channel channel: The closed channel
+        :param Exception reason: why the channel was closed
+        """
+        LOGGER.warning('Channel %i of queue %s was closed: %s', channel, self._queue_name, reason)
+        self._consuming = False
+        if not self._stopped and self._connection.is_connect():
+            self._connection.call_later(1, self.start_consuming)
+
+    def on_connection_recovered(self):
+        """Invoked by the connection once its channel is open again after a
+        failure. The consumer consumes again, on the new shared channel or on
+        a new dedicated channel, if it had been started and was not stopped
+        on purpose.
+        """
+        if not self._started or self._stopped:
+            return
+        if self._dedicated_channel and self._channel is not None and self._channel.is_open:
+            return
+
+        LOGGER.info('Re-registering consumer for queue: %s', self._queue_name)
+        self._consuming = False
+        self.start_consuming()
+
     @abstractmethod
     def on_message(self, _unused_channel, basic_deliver, properties, body):
         pass
@@ -52,10 +130,22 @@ class BaseConsumer(ABC):
         LOGGER.info('Acknowledging message %s', delivery_tag)
         self._channel.basic_ack(delivery_tag)
 
+    def reject_message(self, delivery_tag, requeue=False):
+        """Reject the message delivery from RabbitMQ by sending a
+        Basic.Nack RPC method for the delivery tag.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool requeue: Whether RabbitMQ should requeue the message
+
+        """
+        LOGGER.warning('Rejecting message %s', delivery_tag)
+        self._channel.basic_nack(delivery_tag, requeue=requeue)
+
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
         Basic.Cancel RPC command.
         """
+        self._stopped = True
         if self._channel:
             LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
             cb = functools.partial(self.on_cancelok, userdata=self._consumer_tag)
@@ -88,7 +178,11 @@ class BaseConsumer(ABC):
 
 
 class ApiConsumer(BaseConsumer, ABC):
-    def __init__(self, connection: RabbitMqConnection, queue_name, vault_helper: VaultHelper, api_key):
+    upstream = None
+
+    def __init__(self, connection: RabbitMqConnection, queue_name, vault_helper: VaultHelper, api_key,
+                 max_workers=None, prefetch_count=None, dedicated_channel=False,
+                 result_sink: ResultSink = None, batch_size=None, batch_timeout=0.05):
         """
         Initialize the ApiConsumer instance.
 
@@ -100,42 +194,392 @@ class ApiConsumer(BaseConsumer, ABC):
             The Vault helper object.
         :param api_key: str
             The API key to fetch from Vault.
+        :param max_workers: int | None
+            The size of the worker pool used to process messages off the
+            IOLoop thread. When None, messages are processed one at a time
+            on the IOLoop thread.
+        :param prefetch_count: int | None
+            Overrides the prefetch count, which defaults to twice the batch
+            size in batch mode and to the pool size otherwise.
+        :param dedicated_channel: bool
+            Consume on a channel of its own, see BaseConsumer. Always on in
+            batch mode.
+        :param result_sink: ResultSink | None
+            Where results are saved, defaults to the process-wide sink
+            configured by the RESULT_SINK environment variables.
+        :param batch_size: int | None
+            Batch mode: gather up to this many deliveries, or as many as
+            arrive within batch_timeout, make one upstream call per unique
+            query_key and ack the batch with a single multiple ack. The pool,
+            if any, runs the calls of one batch in parallel. Delivery tags
+            belong to the channel, so the batch consumer gets a channel of
+            its own: on a shared one, the multiple ack would also cover
+            unprocessed deliveries of the other consumers.
+        :param batch_timeout: float
+            The maximum seconds a delivery waits for its batch to fill up.
         """
-        super().__init__(connection, queue_name)
+        super().__init__(connection, queue_name,
+                         prefetch_count=prefetch_count or (2 * batch_size if batch_size else max_workers) or 1,
+                         dedicated_channel=dedicated_channel or bool(batch_size))
         self._vault_helper = vault_helper
         self._api_key = api_key
-
-    def on_message(self, _unused_channel, basic_deliver, properties, body):
+        self._result_sink = result_sink or get_default_sink()
+        self._result_name = self.__class__.__name__.lower().replace('consumer', '')
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._batch = []
+        self._batch_generation = 0
+        self._batch_in_flight = False
+        self._held = {}
+        self._executor = None
+        if max_workers:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix=self.__class__.__name__)
+
+    def on_message(self, channel, basic_deliver, properties, body):
         LOGGER.info('Received message # %s from %s: %s',
                     basic_deliver.delivery_tag, properties.app_id, body)
 
+        if self._batch_size:
+            self.__add_to_batch(channel, basic_deliver.delivery_tag, properties, body)
+            return
+
+        if self._executor is None:
+            self.__process_inline(channel, basic_deliver.delivery_tag, properties, body)
+            return
+
+        self._executor.submit(self.__process_in_worker, channel, basic_deliver.delivery_tag, properties, body,
+                              time.perf_counter())
+
+    def process_message(self, properties, body, block=True):
+        """
+        Fetch the API key, call the upstream API through its rate limiter
+        and circuit breaker, and save the response.
+
+        :param pika.spec.BasicProperties properties: The message properties
+        :param bytes body: The message body
+        :param bool block: Wait for the rate limiter, see guarded_request
+        """
         json_data = json.loads(body)
-        api_key = self._vault_helper.get_api_key(alias=self._api_key)
+        response = self.__call_upstream(json_data, block)
+        self.save_response(response, task_ids=[properties.message_id or uuid.uuid4().hex])
+
+    def query_key(self, json_data):
+        """
+        The key under which identical queries are collapsed in batch mode.
+        String values are stripped and lower-cased, so 'Paris' and ' paris'
+        share one upstream call.
+
+        :param dict json_data: The message body
+        :rtype: str
+        """
+        normalized = {key: value.strip().lower() if isinstance(value, str) else value
+                      for key, value in json_data.items()}
+        return json.dumps(normalized, sort_keys=True)
+
+    def __call_upstream(self, json_data, block=True):
+        """
+        Fetch the API key and call the upstream API through its rate limiter
+        and circuit breaker.
+
+        :param dict json_data: The message body
+        :param bool block: Wait for the rate limiter, see guarded_request
+        :rtype: requests.Response
+        """
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'vault').time():
+            api_key = self._vault_helper.get_api_key(alias=self._api_key)
 
-        LOGGER.info('API key: %s', api_key)
         LOGGER.info('Json data for %s: %s', self.__class__.__name__, json_data)
 
-        response = self.make_api_request(api_key, json_data)
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'upstream').time():
+            return guarded_request(self.upstream, lambda: self.make_api_request(api_key, json_data), block)
 
-        self.save_response(response)
-        LOGGER.debug('Response: %s', response.json())
+    def __add_to_batch(self, channel, delivery_tag, properties, body):
+        """
+        Add a delivery to the pending batch, on the IOLoop thread. The batch
+        is flushed once it is full or batch_timeout after its first delivery.
+        """
+        self._batch.append((channel, delivery_tag, properties, body))
+        if len(self._batch) >= self._batch_size:
+            self.__flush_batch()
+        elif len(self._batch) == 1:
+            self.__schedule_batch_timeout()
+
+    def __schedule_batch_timeout(self):
+        generation = self._batch_generation
+        self._connection.call_later(self._batch_timeout, functools.partial(self.__on_batch_timeout, generation))
+
+    def __on_batch_timeout(self, generation):
+        if generation == self._batch_generation:
+            self.__flush_batch()
+
+    def __flush_batch(self):
+        """
+        Process the pending batch. Only one batch is in flight at a time:
+        its multiple ack then never covers a delivery of a later batch, whose
+        delivery tags are all higher. Deliveries arriving meanwhile form the
+        next batch, flushed as soon as this one is settled.
+        """
+        if self._batch_in_flight or not self._batch:
+            return
+
+        batch, self._batch = self._batch[:self._batch_size], self._batch[self._batch_size:]
+        self._batch_generation += 1
+        self._batch_in_flight = True
+        if self._batch:
+            self.__schedule_batch_timeout()
+
+        groups = {}
+        results = []
+        for delivery in batch:
+            try:
+                json_data = json.loads(delivery[3])
+                key = self.query_key(json_data)
+            except (ValueError, AttributeError) as e:
+                LOGGER.exception('Failed to parse message %s', delivery[1])
+                results.append(([delivery], e))
+                continue
+            groups.setdefault(key, (json_data, []))[1].append(delivery)
+
+        LOGGER.info('Processing a batch of %i messages with %i unique queries', len(batch), len(groups))
+
+        if self._executor is None or not groups:
+            for json_data, deliveries in groups.values():
+                results.append((deliveries, self.__process_group(json_data, deliveries, block=False)))
+            self.__settle_batch(results)
+            return
+
+        lock = threading.Lock()
+        remaining = [len(groups)]
+
+        # Every group must be counted down, whatever happens to it, or the
+        # batch is never settled and the next one never starts.
+        def finish_group(deliveries, error):
+            with lock:
+                results.append((deliveries, error))
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self._connection.add_callback_threadsafe(functools.partial(self.__settle_batch, results,
+                                                                           time.perf_counter()))
+
+        def on_group_done(deliveries, future):
+            try:
+                error = future.result()
+            except Exception as e:  # cancelled by the pool shutdown in on_cancelok
+                error = e
+            finish_group(deliveries, error)
+
+        for json_data, deliveries in groups.values():
+            try:
+                future = self._executor.submit(self.__process_group, json_data, deliveries)
+            except RuntimeError:
+                LOGGER.warning('Worker pool is shut down, requeueing %i messages', len(deliveries))
+                finish_group(deliveries, CancelledError())
+                continue
+            future.add_done_callback(functools.partial(on_group_done, deliveries))
+
+    def __process_group(self, json_data, deliveries, block=True):
+        """
+        Make one upstream call for identical queries and save the response
+        under the task ID of every delivery.
+
+        :param dict json_data: The query shared by the deliveries
+        :param list deliveries: (channel, delivery_tag, properties, body) tuples
+        :param bool block: Wait for the rate limiter, False on the IOLoop thread
+        :rtype: Exception | None
+        :return: None on success, else the error
+        """
+        try:
+            response = self.__call_upstream(json_data, block)
+            self.save_response(response, task_ids=[properties.message_id or uuid.uuid4().hex
+                                                   for _, _, properties, _ in deliveries])
+        except CircuitOpenError as e:
+            return e
+        except Exception as e:
+            LOGGER.exception('Failed to process %i messages', len(deliveries))
+            return e
+        return None
+
+    def __settle_batch(self, results, processed_at=None):
+        """
+        Settle a processed batch on the IOLoop thread: failed deliveries are
+        nacked one by one, deliveries that met an open circuit are held and
+        requeued later, deliveries the worker pool cancelled are requeued,
+        and the rest is acked with a single multiple ack per channel. Individual acks are used instead while held deliveries are
+        outstanding on the channel, since a multiple ack would cover them.
+
+        :param list results: (deliveries, error) pairs
+        :param float processed_at: When the last group finished, for the ack stage
+        """
+        self._batch_in_flight = False
+        processed_at = processed_at or time.perf_counter()
+
+        acked = {}
+        for deliveries, error in results:
+            for channel, delivery_tag, _, _ in deliveries:
+                if error is None:
+                    acked.setdefault(channel, []).append(delivery_tag)
+                elif isinstance(error, CircuitOpenError):
+                    self.__requeue_later(channel, delivery_tag, error.retry_after)
+                elif isinstance(error, CancelledError):
+                    self.__settle_message(channel, delivery_tag, ack=False, requeue=True)
+                else:
+                    self.__settle_message(channel, delivery_tag, ack=False)
+
+        for channel, delivery_tags in acked.items():
+            if not channel.is_open:
+                LOGGER.warning('Channel closed before %i messages were settled', len(delivery_tags))
+                continue
+            if self._held.get(channel):
+                for delivery_tag in delivery_tags:
+                    channel.basic_ack(delivery_tag)
+            else:
+                LOGGER.info('Acknowledging %i messages up to %s', len(delivery_tags), max(delivery_tags))
+                channel.basic_ack(max(delivery_tags), multiple=True)
+            CONSUMER_MESSAGES.labels(self._result_name, 'ack').inc(len(delivery_tags))
+            # One sample per message, as on the unbatched path, so the stage
+            # counts match the message counts.
+            elapsed = time.perf_counter() - processed_at
+            ack_stage = CONSUMER_STAGE_SECONDS.labels(self._result_name, 'ack')
+            for _ in delivery_tags:
+                ack_stage.observe(elapsed)
+
+        self.__flush_batch()
+
+    def __process_inline(self, channel, delivery_tag, properties, body):
+        """
+        Process the message on the IOLoop thread, without a worker pool.
+
+        Errors are settled as in __process_in_worker instead of escaping into
+        the IOLoop. The rate limiter is not waited for: without a token the
+        message is held and requeued once one is due.
+
+        :param pika.channel.Channel channel: The channel the message came from
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param pika.spec.BasicProperties properties: The message properties
+        :param bytes body: The message body
+        """
+        try:
+            self.process_message(properties, body, block=False)
+        except CircuitOpenError as e:
+            LOGGER.warning('Holding message %s for %.1f seconds: %s', delivery_tag, e.retry_after, e)
+            self.__requeue_later(channel, delivery_tag, e.retry_after)
+        except Exception:
+            LOGGER.exception('Failed to process message %s', delivery_tag)
+            self.__settle_message(channel, delivery_tag, ack=False)
+        else:
+            self.__settle_message(channel, delivery_tag, ack=True, processed_at=time.perf_counter())
+
+    def __process_in_worker(self, channel, delivery_tag, properties, body, received_at):
+        """
+        Process the message on a worker thread and hand the ack or nack back
+        to the IOLoop thread.
 
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        The channel the message was delivered on is captured so the ack never
+        goes out on a different channel than the delivery.
+
+        :param pika.channel.Channel channel: The channel the message came from
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param pika.spec.BasicProperties properties: The message properties
+        :param bytes body: The message body
+        :param float received_at: When the IOLoop thread received the message
+        """
+        CONSUMER_STAGE_SECONDS.labels(self._result_name, 'queue').observe(time.perf_counter() - received_at)
+        try:
+            self.process_message(properties, body)
+        except CircuitOpenError as e:
+            LOGGER.warning('Holding message %s for %.1f seconds: %s', delivery_tag, e.retry_after, e)
+            cb = functools.partial(self.__requeue_later, channel, delivery_tag, e.retry_after)
+        except Exception:
+            LOGGER.exception('Failed to process message %s', delivery_tag)
+            cb = functools.partial(self.__settle_message, channel, delivery_tag, ack=False)
+        else:
+            cb = functools.partial(self.__settle_message, channel, delivery_tag, ack=True,
+                                   processed_at=time.perf_counter())
+        self._connection.add_callback_threadsafe(cb)
+
+    def __requeue_later(self, channel, delivery_tag, delay):
+        """
+        Requeue the message once the open circuit is due for a trial call.
+        Holding it unacked until then keeps the prefetch window full, so
+        RabbitMQ stops delivering while the upstream is unhealthy.
+
+        :param pika.channel.Channel channel: The channel the message came from
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param float delay: The seconds to hold the message
+        """
+        self._held[channel] = self._held.get(channel, 0) + 1
+        self._connection.call_later(delay, functools.partial(self.__release_held, channel, delivery_tag))
+
+    def __release_held(self, channel, delivery_tag):
+        self._held[channel] -= 1
+        self.__settle_message(channel, delivery_tag, ack=False, requeue=True)
+
+    def __settle_message(self, channel, delivery_tag, ack, requeue=False, processed_at=None):
+        """
+        Ack or nack the message on the IOLoop thread. If the channel was closed
+        in the meantime RabbitMQ has already requeued the message.
+
+        :param pika.channel.Channel channel: The channel the message came from
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool ack: Whether to ack or nack the message
+        :param bool requeue: Whether a nacked message goes back to the queue
+        :param float processed_at: When processing finished, for the ack stage
+        """
+        if not channel.is_open:
+            LOGGER.warning('Channel closed before message %s was settled', delivery_tag)
+            return
+        if ack:
+            LOGGER.info('Acknowledging message %s', delivery_tag)
+            channel.basic_ack(delivery_tag)
+            if processed_at is not None:
+                CONSUMER_STAGE_SECONDS.labels(self._result_name, 'ack').observe(time.perf_counter() - processed_at)
+        else:
+            LOGGER.warning('Rejecting message %s', delivery_tag)
+            channel.basic_nack(delivery_tag, requeue=requeue)
+        CONSUMER_MESSAGES.labels(self._result_name, 'ack' if ack else 'requeue' if requeue else 'nack').inc()
+
+    def on_cancelok(self, _unused_frame, userdata):
+        """Stop the worker pool before the channel is closed. Messages still
+        waiting in the pool are dropped and requeued by RabbitMQ once the
+        channel goes away.
+
+        :param pika.frame.Method _unused_frame: The Basic.CancelOk frame
+        :param str|unicode userdata: Extra user data (consumer tag)
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        super().on_cancelok(_unused_frame, userdata)
 
     @abstractmethod
     def make_api_request(self, api_key: str, json_data: dict) -> requests.Response:
         pass
 
-    def save_response(self, response: requests.Response):
-        data_dir = Path('data')
-        data_dir.mkdir(exist_ok=True)
+    def save_response(self, response: requests.Response, task_ids):
+        """
+        Hand the response to the result sink. The sink buffers and writes on
+        its own thread, so this does no disk or database I/O.
+
+        :param requests.Response response: The response from the API
+        :param list[str] task_ids: The IDs the result is stored under, one
+            per message answered by this response
+        """
+        with CONSUMER_STAGE_SECONDS.labels(self._result_name, 'save').time():
+            result = response.json()
+            LOGGER.debug('Response: %s', result)
 
-        filename = data_dir / f"{self.__class__.__name__.lower().replace('consumer', '')}_data.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(response.json(), f, indent=4, ensure_ascii=False)
+            for task_id in task_ids:
+                self._result_sink.write(self._result_name, {
+                    'task_id': task_id,
+                    'status': 'SUCCESS' if response.ok else 'FAILURE',
+                    'result': result,
+                    'error': None if response.ok else f'HTTP {response.status_code}',
+                })
 
 
 class WeatherConsumer(ApiConsumer):
+    upstream = 'weatherapi'
 
     def make_api_request(self, api_key: str, json_data: dict) -> requests.Response:
         """
@@ -146,8 +590,8 @@ class WeatherConsumer(ApiConsumer):
         :return: The response from the API
         :rtype: requests.Response
         """
-        return requests.get(
-            url='http://api.weatherapi.com/v1/current.json',
+        return get_session().get(
+            url=WEATHER_API_URL,
             params={
                 'key': api_key,
                 'q': json_data.get('q')
@@ -156,6 +600,7 @@ class WeatherConsumer(ApiConsumer):
 
 
 class EventConsumer(ApiConsumer):
+    upstream = 'ticketmaster'
 
     def make_api_request(self, api_key: str, json_data: dict) -> requests.Response:
         """
@@ -166,8 +611,8 @@ class EventConsumer(ApiConsumer):
         :return: The response from the API
         :rtype: requests.Response
         """
-        return requests.get(
-            url='https://app.ticketmaster.com/discovery/v2/events.json',
+        return get_session().get(
+            url=EVENTS_API_URL,
             params={
                 'apikey': api_key,
                 'city': json_data.get('city')
@@ -0,0 +1,156 @@
+import functools
+import itertools
+import logging
+import multiprocessing
+import threading
+
+import metrics
+from broker_connection import RabbitMqConnection
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+
+
+class ConsumerSpec:
+    def __init__(self, consumer_class, queue_name, channels=1, **consumer_kwargs):
+        """
+        Describe how one consumer class is scaled inside a ConsumerHost.
+
+        :param type consumer_class: The BaseConsumer subclass to run
+        :param str queue_name: The name of the queue to consume from
+        :param int channels: The number of consumer instances per connection,
+            each on its own channel
+        :param consumer_kwargs: Extra keyword arguments for the consumer, e.g.
+            vault_helper, api_key, max_workers or prefetch_count
+        """
+        self.consumer_class = consumer_class
+        self.queue_name = queue_name
+        self.channels = channels
+        self.consumer_kwargs = consumer_kwargs
+
+    def build(self, connection: RabbitMqConnection):
+        """
+        Create the consumers of this spec on the given connection.
+
+        :param RabbitMqConnection connection: The RabbitMQ connection object
+        :rtype: list
+        :return: The consumers, not started yet
+        """
+        return [self.consumer_class(connection, self.queue_name, dedicated_channel=True, **self.consumer_kwargs)
+                for _ in range(self.channels)]
+
+
+class ConsumerHost:
+    # Worker processes of every host in this program serve their metrics
+    # on consecutive ports after METRICS_PORT.
+    _metrics_offsets = itertools.count(1)
+
+    def __init__(self, amqp_url, specs, connections=1, processes=1, on_ready_callback=None):
+        """
+        Run consumers over several channels, connections and processes.
+
+        Every process opens `connections` connections, each with its own
+        IOLoop thread, and every connection runs `spec.channels` consumers of
+        each spec on dedicated channels.
+
+        :param str amqp_url: The AMQP URL used to connect to RabbitMQ
+        :param list[ConsumerSpec] specs: The consumers to run
+        :param int connections: The number of connections per process
+        :param int processes: The number of processes; more than one forks
+            worker processes, each with their own connections
+        :param callable on_ready_callback: Called with each connection before
+            its consumers start, e.g. to declare the topology
+        """
+        self._amqp_url = amqp_url
+        self._specs = specs
+        self._connections_per_process = connections
+        self._processes = processes
+        self._on_ready_callback = on_ready_callback
+        self._connections = []
+        self._threads = []
+        self._children = []
+
+    def fork(self):
+        """
+        Fork the worker processes, when there is more than one.
+
+        Forking a process that already runs threads can leave their locks
+        held in the child, so fork every host before anything in the program
+        starts a thread: connection IOLoops, result sinks, secret refreshes
+        or the metrics server. start() forks on its own if this was not done.
+        """
+        if self._processes <= 1 or self._children:
+            return
+        if threading.active_count() > 1:
+            LOGGER.warning('Forking consumer processes while %i threads are running',
+                           threading.active_count())
+
+        context = multiprocessing.get_context('fork')
+        for index in range(self._processes):
+            process = context.Process(target=functools.partial(self.__run_child, next(self._metrics_offsets)),
+                                      name=f'consumer-host-{index}')
+            process.start()
+            self._children.append(process)
+        LOGGER.info('Started %i consumer processes', len(self._children))
+
+    def start(self):
+        """
+        Start the consumers without blocking the calling thread.
+        """
+        if self._processes > 1:
+            self.fork()
+            return
+
+        for index in range(self._connections_per_process):
+            connection = RabbitMqConnection(self._amqp_url, on_ready_callback=self.__on_connection_ready)
+            thread = threading.Thread(target=connection.run, name=f'consumer-connection-{index}')
+            thread.start()
+            self._connections.append(connection)
+            self._threads.append(thread)
+        LOGGER.info('Started %i consumer connections', len(self._connections))
+
+    def run_in_process(self):
+        """
+        Run the connections of one process until they are stopped.
+        """
+        self._processes = 1
+        self._children = []
+        self.start()
+        self.join()
+
+    def __run_child(self, metrics_offset):
+        """
+        Run a forked worker process. Its metrics start from zero and are
+        served on METRICS_PORT + metrics_offset, next to the parent's.
+        """
+        metrics.reset()
+        metrics.start_metrics_server(offset=metrics_offset)
+        self.run_in_process()
+
+    def join(self):
+        """
+        Wait until every connection thread and worker process has finished.
+        """
+        for thread in self._threads:
+            thread.join()
+        for process in self._children:
+            process.join()
+
+    def stop(self):
+        """
+        Stop every connection of this process and terminate worker processes.
+        """
+        for connection in self._connections:
+            connection.add_callback_threadsafe(connection.stop)
+        for process in self._children:
+            process.terminate()
+
+    def __on_connection_ready(self, connection):
+        if self._on_ready_callback:
+            self._on_ready_callback(connection)
+
+        for spec in self._specs:
+            for consumer in spec.build(connection):
+                consumer.start_consuming()
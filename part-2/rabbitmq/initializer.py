@@ -12,23 +12,26 @@ class RabbitMQInitializer:
         :param str exchange: The name of the exchange to declare
         """
         self._connection = connection
-        self._channel = connection.channel
         self._queues = queues
         self._exchange = exchange
+        self._connection.add_on_recovery_callback(self.init)
 
     def init(self):
         """
         Initialize RabbitMQ by declaring the exchange and queues.
 
+        Also runs again on the new channel whenever the connection recovers.
+
         :raises RuntimeError: If RabbitMQ connection is not ready
         """
         if not self._connection.ready:
             raise RuntimeError('RabbitMQ connection must be established')
 
-        self._connection.channel.exchange_declare(exchange=self._exchange,
-                                                  exchange_type='direct',
-                                                  durable=True)
+        channel = self._connection.channel
+        channel.exchange_declare(exchange=self._exchange,
+                                 exchange_type='direct',
+                                 durable=True)
         for queue in self._queues:
             routing_key = f'task.{queue}'
-            self._channel.queue_declare(queue=queue)
-            self._channel.queue_bind(exchange=self._exchange, queue=queue, routing_key=routing_key)
+            channel.queue_declare(queue=queue)
+            channel.queue_bind(exchange=self._exchange, queue=queue, routing_key=routing_key)
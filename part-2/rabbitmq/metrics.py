@@ -0,0 +1,142 @@
+import contextlib
+import logging
+import os
+import threading
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:  # the metrics extra is not installed
+    start_http_server = None
+
+    class _NoopMetric:
+        """
+        Stands in for a prometheus_client metric, recording nothing.
+        """
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def labels(self, *values, **kwargs):
+            return self
+
+        def inc(self, amount=1):
+            pass
+
+        def dec(self, amount=1):
+            pass
+
+        def set(self, value):
+            pass
+
+        def observe(self, value):
+            pass
+
+        def time(self):
+            return contextlib.nullcontext()
+
+        def clear(self):
+            pass
+
+        def reset(self):
+            pass
+
+    Counter = Gauge = Histogram = _NoopMetric
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_server_port = None
+_server_pid = None
+_server_lock = threading.Lock()
+
+
+def reset():
+    """
+    Drop the values of every metric, e.g. in a forked child that should not
+    report its parent's counts again.
+    """
+    for metric in (CONSUMER_STAGE_SECONDS, CONSUMER_MESSAGES, PUBLISHER_CONFIRM_SECONDS):
+        metric.clear()
+    PUBLISHER_UNCONFIRMED.set(0)
+    RABBITMQ_BLOCKED_CONNECTIONS.set(0)
+    RABBITMQ_BLOCKED_SECONDS.reset()
+    RABBITMQ_RECONNECTS.reset()
+    RABBITMQ_CHANNEL_RECOVERIES.reset()
+
+
+def start_metrics_server(port=None, offset=0):
+    """
+    Serve /metrics from a background thread, once per process.
+
+    Needs the metrics extra (prometheus-client); without it an error is
+    logged and nothing is served.
+
+    :param int port: The port, defaults to the METRICS_PORT environment
+        variable; nothing is served when neither is set
+    :param int offset: Added to the port, so forked processes of one host
+        each get a port of their own
+    :rtype: int | None
+    :return: The port served on, or None when disabled
+    """
+    global _server_port, _server_pid
+
+    if port is None:
+        port = int(os.getenv('METRICS_PORT', '0')) or None
+    if port is None:
+        return None
+    if start_http_server is None:
+        LOGGER.error('METRICS_PORT is set but prometheus-client is not installed, install the metrics extra')
+        return None
+
+    with _server_lock:
+        if _server_port is not None and _server_pid == os.getpid():
+            return _server_port
+
+        start_http_server(port + offset, addr=os.getenv('METRICS_HOST', '0.0.0.0'))
+        _server_port = port + offset
+        _server_pid = os.getpid()
+        LOGGER.info('Serving metrics on port %i', _server_port)
+        return _server_port
+
+
+CONSUMER_STAGE_SECONDS = Histogram(
+    'consumer_stage_seconds',
+    'Time spent per message in each processing stage: queue (waiting for a worker), '
+    'vault, upstream, save and ack (from the end of processing until the ack is sent)',
+    ('task_type', 'stage'),
+    buckets=DEFAULT_BUCKETS)
+
+CONSUMER_MESSAGES = Counter(
+    'consumer_messages_total',
+    'Messages settled by the consumers, by outcome (ack, nack, requeue)',
+    ('task_type', 'outcome'))
+
+PUBLISHER_CONFIRM_SECONDS = Histogram(
+    'publisher_confirm_seconds',
+    'Time from publishing a message until RabbitMQ confirms or rejects it',
+    ('task_type', 'result'),
+    buckets=DEFAULT_BUCKETS)
+
+PUBLISHER_UNCONFIRMED = Gauge(
+    'publisher_unconfirmed_messages',
+    'Messages published and waiting for a confirm')
+
+RABBITMQ_RECONNECTS = Counter(
+    'rabbitmq_reconnects_total',
+    'Reconnects to RabbitMQ after the connection failed or was lost')
+
+RABBITMQ_CHANNEL_RECOVERIES = Counter(
+    'rabbitmq_channel_recoveries_total',
+    'Channels reopened after a channel or connection failure')
+
+RABBITMQ_BLOCKED_CONNECTIONS = Gauge(
+    'rabbitmq_connection_blocked',
+    'Connections on which RabbitMQ currently blocks publishing (memory or disk alarm)')
+
+RABBITMQ_BLOCKED_SECONDS = Counter(
+    'rabbitmq_connection_blocked_seconds_total',
+    'Time connections spent blocked by RabbitMQ, added when the block ends')
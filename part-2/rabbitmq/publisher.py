@@ -1,5 +1,13 @@
+import functools
+import itertools
 import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import ClassVar
 from broker_connection import RabbitMqConnection
+from metrics import PUBLISHER_CONFIRM_SECONDS, PUBLISHER_UNCONFIRMED
 import pika
 import json
 
@@ -8,15 +16,49 @@ LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
 LOGGER = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 
+_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+
+class PublisherBackpressureError(Exception):
+    """Raised when the publisher's outbound queue has no room for more messages."""
+
 
 class TaskPublisher:
     ROUTING_KEY_FOR_WEATHER = 'task.weather'
     ROUTING_KEY_FOR_EVENTS = 'task.events'
     EXCHANGE = 'task.exchange'
 
-    def __init__(self, connection: RabbitMqConnection):
+    ROUTING_KEYS: ClassVar[dict[str, str]] = {
+        'weather': ROUTING_KEY_FOR_WEATHER,
+        'events': ROUTING_KEY_FOR_EVENTS,
+    }
+
+    def __init__(self, connection: RabbitMqConnection, max_unconfirmed=1000, max_pending=10000):
+        """
+        Initialize the TaskPublisher object.
+
+        :param RabbitMqConnection connection: The RabbitMQ connection object
+        :param int max_unconfirmed: The maximum number of published messages
+            waiting for a confirm; further messages are held back until
+            RabbitMQ confirms earlier ones
+        :param int max_pending: The maximum number of messages held by the
+            publisher, queued or unconfirmed; producers are throttled or
+            rejected beyond it
+        """
         self._connection = connection
+        self._properties = pika.BasicProperties(app_id='example-publisher',
+                                                content_type='application/json')
+        self._max_unconfirmed = max_unconfirmed
+        self._max_pending = max_pending
+        self._message_number = 0
+        self._unconfirmed = {}
+        self._pending = deque()
+        self._capacity = threading.Condition()
+        self._in_flight = 0
+        self._throttled_seconds = 0.0
         self.__setup_delivery_confirmation()
+        self._connection.add_on_flow_control_callback(self.__on_flow_control)
+        self._connection.add_on_recovery_callback(self.__on_connection_recovered)
 
     def __setup_delivery_confirmation(self):
         """
@@ -43,43 +85,194 @@ class TaskPublisher:
         pika.frame.Method object as an argument. The method object
         contains information about whether the message was confirmed or
         rejected.
+
+        Every published message is tracked by its delivery tag. The future
+        of each message covered by the frame (all tags up to and including
+        delivery_tag when multiple is set) is resolved with True on ack and
+        False on nack, and held back messages are published into the freed
+        window.
         """
         confirmation_type = method_frame.method.NAME.split('.')[1].lower()
-        if confirmation_type == 'ack':
-            LOGGER.debug("Message confirmed")
+        delivery_tag = method_frame.method.delivery_tag
+        acked = confirmation_type == 'ack'
+
+        if method_frame.method.multiple:
+            delivery_tags = list(itertools.takewhile(lambda tag: tag <= delivery_tag, self._unconfirmed))
+        else:
+            delivery_tags = [delivery_tag]
+
+        resolved = 0
+        now = time.perf_counter()
+        for tag in delivery_tags:
+            entry = self._unconfirmed.pop(tag, None)
+            if entry is None:
+                continue
+            future, routing_key, published_at = entry
+            PUBLISHER_UNCONFIRMED.dec()
+            PUBLISHER_CONFIRM_SECONDS.labels(routing_key.split('.', 1)[-1], confirmation_type).observe(
+                now - published_at)
+            if not future.done():
+                future.set_result(acked)
+                resolved += 1
+        self.__release(resolved)
+
+        if acked:
+            LOGGER.debug("Message %s confirmed (multiple=%s)", delivery_tag, method_frame.method.multiple)
         else:
-            LOGGER.warning("Message rejected")
+            LOGGER.warning("Message %s rejected (multiple=%s)", delivery_tag, method_frame.method.multiple)
+
+        self.__publish_pending()
+
+    def __on_connection_recovered(self):
+        """
+        Called by the connection once its channel is open again after a
+        failure. Messages that were waiting for a confirm on the old channel
+        may or may not have reached RabbitMQ, so their futures are resolved
+        with False for the caller to retry. Delivery tags restart on the new
+        channel and queued messages are published on it.
+        """
+        futures = [future for future, _, _ in self._unconfirmed.values()]
+        self._unconfirmed.clear()
+        PUBLISHER_UNCONFIRMED.dec(len(futures))
+        self._message_number = 0
+        for future in futures:
+            if not future.done():
+                future.set_result(False)
+        self.__release(len(futures))
+        if futures:
+            LOGGER.warning('%i messages were unconfirmed when the channel was lost', len(futures))
+
+        self.__setup_delivery_confirmation()
+        self.__publish_pending()
+
+    def __on_flow_control(self, blocked):
+        """
+        Called by the connection when RabbitMQ blocks or unblocks publishing.
+        While blocked, messages stay in the outbound queue; once unblocked the
+        queue is drained again.
+
+        :param bool blocked: Whether publishing is blocked
+        """
+        if not blocked:
+            self.__publish_pending()
+
+    def publish_many(self, tasks):
+        """
+        Publish many tasks at once.
+
+        Each task is a dict with a task_type of 'weather' or 'events' and the
+        task payload, e.g. {'task_type': 'weather', 'q': 'Paris'}. Bodies are
+        serialized up front and published with shared properties; messages
+        beyond the unconfirmed window, or sent while RabbitMQ blocks the
+        connection, are queued and sent as soon as possible.
+
+        Must be called on the IOLoop thread. Use publish_many_threadsafe from
+        other threads.
+
+        :param iterable tasks: The tasks to publish
+        :raises PublisherBackpressureError: If the outbound queue has no room
+        :return: One future per task, resolved with True when RabbitMQ
+            confirms the message and False when it rejects it
+        :rtype: list[concurrent.futures.Future]
+        """
+        messages = self.__prepare(tasks)
+        with self._capacity:
+            if self._in_flight + len(messages) > self._max_pending:
+                raise PublisherBackpressureError(
+                    f'{self._in_flight} messages in flight, cannot add {len(messages)}')
+            self._in_flight += len(messages)
+
+        return self.__enqueue(messages)
+
+    def publish_many_threadsafe(self, tasks, timeout=None):
+        """
+        Publish many tasks from a thread other than the IOLoop thread.
+
+        Blocks the calling thread until the outbound queue has room for all
+        tasks, so a slow or blocked broker throttles producers instead of
+        growing memory.
+
+        :param iterable tasks: The tasks to publish, see publish_many
+        :param float timeout: Seconds to wait for room, None waits forever
+        :raises PublisherBackpressureError: If no room was freed in time
+        :return: One future per task, see publish_many
+        :rtype: list[concurrent.futures.Future]
+        """
+        messages = self.__prepare(tasks)
+        if len(messages) > self._max_pending:
+            raise ValueError(f'Cannot publish more than {self._max_pending} messages at once')
+
+        started = time.monotonic()
+        with self._capacity:
+            has_room = self._capacity.wait_for(
+                lambda: self._in_flight + len(messages) <= self._max_pending, timeout)
+            self._throttled_seconds += time.monotonic() - started
+            if not has_room:
+                raise PublisherBackpressureError(f'No room for {len(messages)} messages after {timeout} seconds')
+            self._in_flight += len(messages)
+
+        self._connection.add_callback_threadsafe(functools.partial(self.__enqueue, messages))
+        return [future for _, _, future in messages]
+
+    @property
+    def throttled_seconds(self):
+        """Total time producer threads have waited for room in the outbound queue, in seconds."""
+        return self._throttled_seconds
+
+    def __prepare(self, tasks):
+        return [(self.ROUTING_KEYS[task['task_type']], _ENCODER.encode(task).encode('utf-8'), Future())
+                for task in tasks]
+
+    def __enqueue(self, messages):
+        self._pending.extend(messages)
+        self.__publish_pending()
+        return [future for _, _, future in messages]
+
+    def __release(self, count):
+        if not count:
+            return
+        with self._capacity:
+            self._in_flight -= count
+            self._capacity.notify_all()
+
+    def __publish_pending(self):
+        """
+        Publish queued messages while the unconfirmed window has room and
+        RabbitMQ is not blocking the connection.
+        """
+        if self._connection.blocked or not self._connection.ready:
+            return
+
+        channel = self._connection.channel
+        while self._pending and len(self._unconfirmed) < self._max_unconfirmed:
+            routing_key, body, future = self._pending.popleft()
+            channel.basic_publish(self.EXCHANGE, routing_key, body, self._properties)
+            self._message_number += 1
+            self._unconfirmed[self._message_number] = (future, routing_key, time.perf_counter())
+            PUBLISHER_UNCONFIRMED.inc()
 
     def publish_weather_task(self, city):
         """
         Publish a weather task for a given city.
 
         :param str city: The city for which the weather task should be published
+        :return: A future resolved when RabbitMQ confirms or rejects the message
+        :rtype: concurrent.futures.Future
         """
-        channel = self._connection.channel
-        properties = pika.BasicProperties(app_id='example-publisher',
-                                          content_type='application/json')
-
-        channel.basic_publish(self.EXCHANGE, self.ROUTING_KEY_FOR_WEATHER,
-                              json.dumps({'task_type': 'weather', 'q': city},
-                                         ensure_ascii=False),
-                              properties)
+        future, = self.publish_many([{'task_type': 'weather', 'q': city}])
 
         LOGGER.info('Published weather task for %s', city)
+        return future
 
     def publish_events_task(self, city):
         """
         Publish an events task for a given city.
 
         :param str city: The city for which the events task should be published
+        :return: A future resolved when RabbitMQ confirms or rejects the message
+        :rtype: concurrent.futures.Future
         """
-        channel = self._connection.channel
-        properties = pika.BasicProperties(app_id='example-publisher',
-                                          content_type='application/json')
-
-        channel.basic_publish(self.EXCHANGE, self.ROUTING_KEY_FOR_EVENTS,
-                              json.dumps({'task_type': 'events', 'city': city},
-                                         ensure_ascii=False),
-                              properties)
+        future, = self.publish_many([{'task_type': 'events', 'city': city}])
 
         LOGGER.info('Published events task for %s', city)
+        return future
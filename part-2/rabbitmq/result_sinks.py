@@ -0,0 +1,253 @@
+from abc import ABC, abstractmethod
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOGGER = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+
+_STOP = object()
+
+_default_sink = None
+_default_sink_pid = None
+_default_sink_lock = threading.Lock()
+
+
+class ResultSink(ABC):
+    """
+    Destination for the results produced by ApiConsumer.
+
+    A record is a dict with the keys task_id, status, result and error, the
+    same shape as the TaskResults table of the Celery lab.
+    """
+
+    @abstractmethod
+    def write(self, name, record):
+        """
+        Store a result record.
+
+        :param str name: The result stream, e.g. 'weather' or 'event'
+        :param dict record: The result record
+        """
+
+    def close(self):
+        """
+        Flush buffered records and release resources.
+        """
+
+
+class BufferedSink(ResultSink, ABC):
+    def __init__(self, max_batch=500, flush_interval=1.0, max_queue=10000):
+        """
+        Buffer records in memory and hand them to flush() in batches from a
+        background thread, whenever max_batch records are collected or
+        flush_interval seconds have passed.
+
+        write() blocks once max_queue records are waiting, so a slow
+        destination throttles the consumers instead of growing memory.
+
+        :param int max_batch: The maximum number of records per flush
+        :param float flush_interval: The maximum seconds a record waits for a flush
+        :param int max_queue: The maximum number of records waiting for a flush
+        """
+        self._max_batch = max_batch
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self.__run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def write(self, name, record):
+        self._queue.put((name, record))
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    @abstractmethod
+    def flush(self, batch):
+        """
+        Write a batch of records to the destination.
+
+        :param list[tuple[str, dict]] batch: (name, record) pairs
+        """
+
+    def __run(self):
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self.__flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self._max_batch or time.monotonic() >= deadline:
+                self.__flush(batch)
+                batch = []
+                deadline = time.monotonic() + self._flush_interval
+
+    def __flush(self, batch):
+        if not batch:
+            return
+        try:
+            self.flush(batch)
+        except Exception:
+            LOGGER.exception('Failed to flush %i records in %s', len(batch), self.__class__.__name__)
+
+
+class JsonLinesSink(BufferedSink):
+    def __init__(self, directory='data', max_bytes=64 * 1024 * 1024, compress=False, **kwargs):
+        """
+        Append records as JSON Lines to <directory>/<name>_data.jsonl.
+
+        Once a file grows past max_bytes it is renamed with a timestamp
+        suffix and a new file is started.
+
+        :param str directory: The directory to write to
+        :param int max_bytes: The size at which a file is rotated
+        :param bool compress: Write gzip-compressed files (.jsonl.gz)
+        :param kwargs: Batching options, see BufferedSink
+        """
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._compress = compress
+        self._suffix = '.jsonl.gz' if compress else '.jsonl'
+        super().__init__(**kwargs)
+
+    def flush(self, batch):
+        lines = {}
+        for name, record in batch:
+            lines.setdefault(name, []).append(json.dumps(record, ensure_ascii=False))
+
+        for name, records in lines.items():
+            path = self._directory / f'{name}_data{self._suffix}'
+            opener = gzip.open if self._compress else open
+            with opener(path, 'at', encoding='utf-8') as f:
+                f.write('\n'.join(records) + '\n')
+
+            if path.stat().st_size >= self._max_bytes:
+                self.__rotate(path, name)
+
+    def __rotate(self, path, name):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        rotated = path.with_name(f'{name}_data.{stamp}{self._suffix}')
+        index = 1
+        while rotated.exists():
+            rotated = path.with_name(f'{name}_data.{stamp}-{index}{self._suffix}')
+            index += 1
+
+        path.rename(rotated)
+        LOGGER.info('Rotated %s to %s', path, rotated)
+
+
+class PostgresSink(BufferedSink):
+    INSERT_SQL = ('INSERT INTO {table} (task_id, status, result, error) VALUES %s '
+                  'ON CONFLICT (task_id) DO UPDATE SET status = EXCLUDED.status, '
+                  'result = EXCLUDED.result, error = EXCLUDED.error')
+
+    def __init__(self, dsn, table='taskresults', **kwargs):
+        """
+        Insert records into the Celery lab's TaskResults table with one
+        multi-row upsert per batch. Requires psycopg2.
+
+        :param str dsn: The PostgreSQL connection string
+        :param str table: The table to insert into
+        :param kwargs: Batching options, see BufferedSink
+        """
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        self._psycopg2 = psycopg2
+        self._execute_values = execute_values
+        self._dsn = dsn
+        self._sql = self.INSERT_SQL.format(table=table)
+        self._db = None
+        super().__init__(**kwargs)
+
+    def flush(self, batch):
+        rows = [(record['task_id'], record['status'], json.dumps(record['result'], ensure_ascii=False),
+                 record['error'])
+                for _, record in batch]
+        try:
+            self.__insert(rows)
+        except self._psycopg2.OperationalError:
+            LOGGER.warning('Lost the database connection, retrying the batch once', exc_info=True)
+            self._db = None
+            self.__insert(rows)
+
+    def close(self):
+        super().close()
+        if self._db is not None:
+            self._db.close()
+
+    def __insert(self, rows):
+        if self._db is None or self._db.closed:
+            self._db = self._psycopg2.connect(self._dsn)
+        with self._db, self._db.cursor() as cursor:
+            self._execute_values(cursor, self._sql, rows, template='(%s, %s, %s::json, %s)',
+                                 page_size=len(rows))
+
+
+def build_result_sink():
+    """
+    Build the result sink selected by environment variables.
+
+    - RESULT_SINK: 'jsonl' (default) or 'postgres'
+    - RESULT_SINK_DIR: the directory of the jsonl sink (default 'data')
+    - RESULT_SINK_MAX_BYTES: the rotation size of the jsonl sink (default 64 MiB)
+    - RESULT_SINK_COMPRESS: gzip the jsonl files when set to 1
+    - RESULT_SINK_DSN: the connection string of the postgres sink
+    - RESULT_SINK_BATCH: the maximum records per flush (default 500)
+    - RESULT_SINK_FLUSH_INTERVAL: the maximum seconds between flushes (default 1)
+
+    :rtype: ResultSink
+    """
+    kind = os.getenv('RESULT_SINK', 'jsonl')
+    options = {
+        'max_batch': int(os.getenv('RESULT_SINK_BATCH', '500')),
+        'flush_interval': float(os.getenv('RESULT_SINK_FLUSH_INTERVAL', '1.0')),
+    }
+
+    if kind == 'jsonl':
+        return JsonLinesSink(directory=os.getenv('RESULT_SINK_DIR', 'data'),
+                             max_bytes=int(os.getenv('RESULT_SINK_MAX_BYTES', str(64 * 1024 * 1024))),
+                             compress=os.getenv('RESULT_SINK_COMPRESS') == '1',
+                             **options)
+    if kind == 'postgres':
+        return PostgresSink(dsn=os.getenv('RESULT_SINK_DSN'), **options)
+    raise ValueError(f'Unknown result sink: {kind}')
+
+
+def get_default_sink():
+    """
+    Get the result sink shared by this process, built on first use.
+
+    The sink is re-created after a fork since its writer thread does not
+    survive it.
+
+    :rtype: ResultSink
+    """
+    global _default_sink, _default_sink_pid
+
+    pid = os.getpid()
+    if _default_sink is None or _default_sink_pid != pid:
+        with _default_sink_lock:
+            if _default_sink is None or _default_sink_pid != pid:
+                _default_sink = build_result_sink()
+                _default_sink_pid = pid
+                atexit.register(_default_sink.close)
+    return _default_sink
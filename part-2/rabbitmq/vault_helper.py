@@ -1,15 +1,27 @@
 from dotenv import load_dotenv
-import requests
+import asyncio
+import functools
+import logging
 import os
+import threading
+import time
+
+from http_client import get_session
+from secret_cache import SecretCache
 
 load_dotenv()
 
+LOGGER = logging.getLogger(__name__)
+
 
 class VaultHelper:
     """
     A helper class for interacting with Hashicorp's Vault.
 
-    This class provides methods for retrieving secrets from Vault.
+    This class provides methods for retrieving secrets from Vault. Secrets
+    are cached in-process (VAULT_SECRET_TTL, VAULT_SECRET_STALE_TTL) and the
+    AppRole client token is renewed before its lease expires
+    (VAULT_TOKEN_RENEW_MARGIN).
     """
 
     def __init__(self):
@@ -17,15 +29,47 @@ class VaultHelper:
         self._vault_address = os.getenv('VAULT_ADDR')
         self._vault_role_id = os.getenv('VAULT_ROLE_ID')
         self._vault_secret_id = os.getenv('VAULT_SECRET_ID')
-        self._client_token = self.__get_client_token()
+        self._token_renew_margin = float(os.getenv('VAULT_TOKEN_RENEW_MARGIN', '60'))
+        self._secrets = SecretCache(ttl=float(os.getenv('VAULT_SECRET_TTL', '300')),
+                                    stale_ttl=float(os.getenv('VAULT_SECRET_STALE_TTL', '600')))
+        self._token_lock = threading.Lock()
+        self._client_token = None
+        self._token_renewable = False
+        self._token_expires_at = 0.0
+        self.__ensure_client_token()
 
-    def __get_client_token(self):
+    def __ensure_client_token(self, force_login=False):
         """
-        Get the client token for Vault.
+        Get a valid client token for Vault.
+
+        The token is renewed shortly before its lease runs out. If it is not
+        renewable, or the renewal fails, a new AppRole login is made.
 
+        :param bool force_login: Skip renewal and log in again
         :return: str
         """
-        resp = requests.post(
+        if not force_login and time.monotonic() < self._token_expires_at - self._token_renew_margin:
+            return self._client_token
+
+        with self._token_lock:
+            if not force_login and time.monotonic() < self._token_expires_at - self._token_renew_margin:
+                return self._client_token
+
+            if not force_login and self._client_token and self._token_renewable:
+                try:
+                    self.__renew_client_token()
+                    return self._client_token
+                except Exception:
+                    LOGGER.warning('Vault token renewal failed, logging in again', exc_info=True)
+
+            self.__login()
+            return self._client_token
+
+    def __login(self):
+        """
+        Log in to Vault with the AppRole credentials.
+        """
+        resp = get_session().post(
             url=f'{self._vault_address}/v1/auth/approle/login',
             json={
                 "role_id": self._vault_role_id,
@@ -34,25 +78,65 @@ class VaultHelper:
         )
 
         json_data = resp.json()
-        return json_data['auth']["client_token"]
+        self.__store_client_token(json_data['auth'])
+
+    def __renew_client_token(self):
+        """
+        Extend the lease of the current client token.
+        """
+        resp = get_session().post(
+            url=f'{self._vault_address}/v1/auth/token/renew-self',
+            headers={
+                "X-Vault-Token": self._client_token
+            }
+        )
+        resp.raise_for_status()
+
+        json_data = resp.json()
+        self.__store_client_token(json_data['auth'])
+
+    def __store_client_token(self, auth):
+        """
+        Remember the client token and when its lease runs out.
+
+        :param dict auth: The auth block of a Vault login or renew response
+        """
+        lease_duration = auth.get('lease_duration', 0)
+        self._client_token = auth['client_token']
+        self._token_renewable = auth.get('renewable', False)
+        self._token_expires_at = time.monotonic() + lease_duration if lease_duration else float('inf')
 
     def __get_secrets(self, secret_path):
+        """
+        Get the secrets from the cache, loading them from Vault on a miss.
+
+        :param secret_path: str
+        :return: dict
+        """
+        return self._secrets.get(secret_path, functools.partial(self.__fetch_secrets, secret_path))
+
+    def __fetch_secrets(self, secret_path):
         """
         Get the secrets from Vault.
 
         :param secret_path: str
         :return: dict
         """
-        resp = requests.get(
+        resp = self.__request_secrets(secret_path, self.__ensure_client_token())
+        if resp.status_code == 403:
+            resp = self.__request_secrets(secret_path, self.__ensure_client_token(force_login=True))
+
+        json_data = resp.json()
+        return json_data['data']['data']
+
+    def __request_secrets(self, secret_path, client_token):
+        return get_session().get(
             url=f'{self._vault_address}/v1/secrets/data/{secret_path}',
             headers={
-                "X-Vault-Token": self._client_token
+                "X-Vault-Token": client_token
             }
         )
 
-        json_data = resp.json()
-        return json_data['data']['data']
-
     def get_api_key(self, alias):
         """
         Get the API key from Vault.
@@ -62,6 +146,20 @@ class VaultHelper:
         """
         return self.__get_secrets(secret_path='apiKeys')[alias]
 
+    async def aget_api_key(self, alias):
+        """
+        Get the API key from Vault without blocking the event loop. Cached
+        keys are returned from memory; a Vault round trip, if needed, runs
+        on a worker thread.
+
+        :param alias: str
+        :return: str
+        """
+        secrets = self._secrets.get_cached('apiKeys', functools.partial(self.__fetch_secrets, 'apiKeys'))
+        if secrets is None:
+            secrets = await asyncio.to_thread(self.__get_secrets, 'apiKeys')
+        return secrets[alias]
+
     def get_rabbitmq_credentials(self):
         """
         Get the RabbitMQ credentials from Vault.
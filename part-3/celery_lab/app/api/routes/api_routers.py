@@ -1,75 +1,185 @@
-from celery.result import AsyncResult
-from fastapi import APIRouter
+import json
+from typing import Annotated
 
+from celery import states
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app.api.deps import AsyncSessionDep
+from app.core.cache import get_cached_response, is_cache_shared
+from app.core.config import settings
+from app.celery.coalescing import submit_coalesced
+from app.celery.results import get_task_statuses, wait_for_task, wait_for_task_statuses, watch_task_statuses
 from app.celery.tasks import make_api_request_weather, make_api_request_event
 
 router = APIRouter(tags=["api"], prefix='/api')
 
 @router.get("/weather/")
-async def get_weather_by_city(city: str):
+async def get_weather_by_city(city: str, wait: float = 0,
+                              priority: Annotated[int | None, Query(ge=0, le=settings.task_queue_max_priority)] = None):
     """
     Get the weather for a given city.
     
     This endpoint will trigger a Celery task to make an API request to WeatherAPI
     to retrieve the current weather for the given city.
     
-    The task ID will be returned in the response.
+    The task ID will be returned in the response. If the weather for the city
+    is already in the shared (database) cache, the result is returned
+    immediately instead and no task is enqueued. Identical queries already in flight share one task ID.
+
+    With wait, the request holds on to the task for up to that many seconds
+    (capped by settings.task_status_wait_max) and returns its result inline
+    when it finishes in time, saving the client a round trip to
+    /api/task/{task_id}.
     
     Parameters:
     - city: str
         The city for which to retrieve the weather.
+    - wait: float
+        The maximum seconds to wait for the result, 0 to return the task ID right away.
+    - priority: int | None
+        The queue priority of the task, higher first: e.g. the maximum for
+        interactive requests, 0 for batch jobs. Defaults to
+        settings.task_default_priority.
     
     Returns:
-    - task_id: str
-        The ID of the Celery task.
+    - task_id: str | None
+        The ID of the Celery task, or None on a cache hit.
+    - status, result:
+        Only on a cache hit or when the task finished within wait, in the
+        same shape as /api/task/{task_id}.
     """
-    task = make_api_request_weather.delay(
-        json_data={'q': city}
-    )
-    return {"task_id": task.id}
+    json_data = {'q': city}
+    if is_cache_shared():
+        cached = await run_in_threadpool(get_cached_response, 'weather', json_data)
+        if cached is not None:
+            return {"task_id": None, "status": "SUCCESS", "result": cached}
+
+    task_id = await run_in_threadpool(submit_coalesced, make_api_request_weather, json_data, priority)
+    if wait > 0:
+        status = await wait_for_task(task_id, wait)
+        if status["status"] in states.READY_STATES:
+            return status
+    return {"task_id": task_id}
 
 
 @router.get("/event/")
-async def get_events_by_city(city: str):
+async def get_events_by_city(city: str, wait: float = 0,
+                             priority: Annotated[int | None, Query(ge=0, le=settings.task_queue_max_priority)] = None):
     """
     Get the events for a given city.
     
     This endpoint will trigger a Celery task to make an API request to Ticketmaster API
     to retrieve the events for the given city.
     
-    The task ID will be returned in the response.
+    The task ID will be returned in the response. If the events for the city
+    are already in the shared (database) cache, the result is returned
+    immediately instead and no task is enqueued. Identical queries already in flight share one task ID.
+
+    With wait, the request holds on to the task for up to that many seconds
+    and returns its result inline when it finishes in time, see
+    /api/weather/.
     
     Parameters:
     - city: str
         The city for which to retrieve the events.
+    - wait: float
+        The maximum seconds to wait for the result, 0 to return the task ID right away.
+    - priority: int | None
+        The queue priority of the task, higher first: e.g. the maximum for
+        interactive requests, 0 for batch jobs. Defaults to
+        settings.task_default_priority.
     
     Returns:
-    - task_id: str
-        The ID of the Celery task.
+    - task_id: str | None
+        The ID of the Celery task, or None on a cache hit.
+    - status, result:
+        Only on a cache hit or when the task finished within wait, in the
+        same shape as /api/task/{task_id}.
     """
-    task = make_api_request_event.delay(
-        json_data={'city': city}
-    )
-    return {"task_id": task.id}
+    json_data = {'city': city}
+    if is_cache_shared():
+        cached = await run_in_threadpool(get_cached_response, 'event', json_data)
+        if cached is not None:
+            return {"task_id": None, "status": "SUCCESS", "result": cached}
+
+    task_id = await run_in_threadpool(submit_coalesced, make_api_request_event, json_data, priority)
+    if wait > 0:
+        status = await wait_for_task(task_id, wait)
+        if status["status"] in states.READY_STATES:
+            return status
+    return {"task_id": task_id}
 
 
 @router.get("/task/{task_id}")
-async def get_task_result(task_id: str):
+async def get_task_result(task_id: str, session: AsyncSessionDep, wait: float = 0):
     """
     Get the result of a Celery task.
 
     This endpoint will retrieve the result of a Celery task with the given task ID.
+    Results persisted to TaskResults are read through the async session first,
+    the Celery result backend is queried off the event loop otherwise.
+
+    Parameters:
+    - task_id: str
+        The ID of the Celery task.
+    - wait: float
+        Long-poll: hold the request for up to this many seconds (capped by
+        settings.task_status_wait_max) and answer as soon as the task is ready.
     """
-    task_result = AsyncResult(task_id)
+    if wait > 0:
+        statuses = await wait_for_task_statuses([task_id], wait)
+    else:
+        statuses = await get_task_statuses(session, [task_id])
+    return statuses[task_id]
+
 
-    result = {
-        "task_id": task_id,
-        "status": task_result.status,
-    }
+@router.get("/task/{task_id}/events")
+async def stream_task_result(task_id: str, timeout: float = settings.task_status_wait_max):
+    """
+    Stream the status of a Celery task as server-sent events.
 
-    if task_result.successful():
-        result["result"] = task_result.result
-    elif task_result.failed():
-        result["error"] = str(task_result.result)
+    An event is sent right away and then every time the status changes; the
+    stream ends once the task is ready or the timeout runs out.
+
+    Parameters:
+    - task_id: str
+        The ID of the Celery task.
+    - timeout: float
+        The maximum seconds to keep the stream open, capped by
+        settings.task_status_wait_max.
+    """
+    async def events():
+        async for statuses in watch_task_statuses([task_id], timeout):
+            yield f"data: {json.dumps(statuses[task_id], default=str)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/tasks/")
+async def get_task_results(session: AsyncSessionDep, task_id: Annotated[list[str], Query()], wait: float = 0):
+    """
+    Get the results of many Celery tasks with one query per store.
+
+    Parameters:
+    - task_id: list[str]
+        The IDs of the Celery tasks, e.g. ?task_id=a&task_id=b, at most
+        settings.task_status_batch_max.
+    - wait: float
+        Long-poll: answer as soon as every task is ready, see /api/task/{task_id}.
+
+    Returns:
+    - A list of task statuses, in the order of the requested IDs.
+    """
+    if len(task_id) > settings.task_status_batch_max:
+        raise HTTPException(status_code=422,
+                            detail=f"At most {settings.task_status_batch_max} task IDs per request")
 
-    return result
+    task_ids = list(dict.fromkeys(task_id))
+    if wait > 0:
+        statuses = await wait_for_task_statuses(task_ids, wait)
+    else:
+        statuses = await get_task_statuses(session, task_ids)
+    return [statuses[task_id] for task_id in task_ids]
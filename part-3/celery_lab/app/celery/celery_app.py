@@ -1,5 +1,153 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
 from celery import Celery
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool as PreforkTaskPool
+from celery.signals import (before_task_publish, task_postrun, task_prerun, worker_init, worker_process_init,
+                            worker_process_shutdown)
+
+from app.celery.profiles import build_worker_config
+from app.core.cache import build_cache_key
+from app.core.config import settings
+from app.core.db import engine
+from app.core.metrics import TASK_QUEUE_WAIT_SECONDS, TASK_RUNTIME_SECONDS, mark_process_dead, start_metrics_server
+from app.core.result_writer import get_task_result_writer
+from app.models import TaskResults
+from app.utils.vault_helper import vault_helper
+
+LOGGER = logging.getLogger(__name__)
 
 celery_app = Celery()
 celery_app.config_from_object('app.celery.celeryconfig')
+celery_app.conf.update(build_worker_config(settings.worker_profile))
+
+SENT_AT_HEADER = 'sent_at'
+
+_task_started = {}
+
+
+@worker_process_init.connect
+def prefetch_vault_secrets(**kwargs):
+    """
+    Warm the Vault token and API keys in the background when a worker
+    process starts, so the first task does not pay for the login and a slow
+    Vault does not hold up worker startup.
+    """
+    if settings.vault_prefetch:
+        threading.Thread(target=vault_helper.prefetch, name='vault-prefetch', daemon=True).start()
+
+
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    """
+    Drop the database connections inherited from the parent process, so
+    forked workers never share a socket.
+    """
+    engine.dispose(close=False)
+
+
+@task_postrun.connect
+def persist_task_result(task_id=None, task=None, kwargs=None, retval=None, state=None, **extra):
+    """
+    Queue the outcome of every task for a batched write to TaskResults,
+    when settings.persist_task_results is enabled.
+    """
+    if not settings.persist_task_results:
+        return
+
+    endpoint = getattr(task, 'endpoint', None)
+    query_key = None
+    if endpoint and kwargs and 'json_data' in kwargs:
+        query_key = build_cache_key(endpoint, kwargs['json_data'])
+
+    succeeded = state == 'SUCCESS'
+    get_task_result_writer().add(TaskResults(
+        task_id=task_id,
+        status=state,
+        result=retval if succeeded and isinstance(retval, dict) else None,
+        error=None if succeeded else str(retval),
+        query_key=query_key,
+    ))
+
+
+@worker_process_shutdown.connect
+def flush_task_results(**kwargs):
+    """
+    Flush queued TaskResults before the worker process exits.
+    """
+    if settings.persist_task_results:
+        get_task_result_writer().close()
+
+
+@worker_init.connect
+def serve_worker_metrics(sender=None, **kwargs):
+    """
+    Serve the worker's metrics on settings.worker_metrics_port, when set.
+
+    Prefork pool processes run the tasks, and their metrics only reach the
+    main process through PROMETHEUS_MULTIPROC_DIR (see
+    app.core.metrics.build_registry). Without it the server would export
+    an empty registry, so an error is logged and nothing is served.
+    """
+    if not settings.worker_metrics_port:
+        return
+
+    if issubclass(get_implementation(sender.pool_cls), PreforkTaskPool) and not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        LOGGER.error('Not serving worker metrics: the prefork pool needs PROMETHEUS_MULTIPROC_DIR')
+        return
+    start_metrics_server(settings.worker_metrics_port)
+
+
+@worker_process_shutdown.connect
+def forget_worker_process_metrics(pid=None, **kwargs):
+    """
+    Drop the live gauges of an exiting pool process from
+    PROMETHEUS_MULTIPROC_DIR.
+    """
+    mark_process_dead(pid or os.getpid())
+
+
+@before_task_publish.connect
+def stamp_sent_at(headers=None, **kwargs):
+    """
+    Stamp every task message, retries included, with the time it was
+    published, for the queue wait metric. Publisher and worker clocks are
+    assumed to be in sync.
+    """
+    if headers is not None:
+        headers[SENT_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def observe_queue_wait(task_id=None, task=None, **kwargs):
+    """
+    Record how long the task waited in its queue: since it was published,
+    or since its ETA for retries and countdowns.
+    """
+    _task_started[task_id] = time.perf_counter()
+
+    sent_at = getattr(task.request, SENT_AT_HEADER, None)
+    if sent_at is None:
+        return
+
+    ready_at = sent_at
+    eta = task.request.eta
+    if eta:
+        ready_at = max(sent_at, (datetime.fromisoformat(eta) if isinstance(eta, str) else eta).timestamp())
+    queue = (task.request.delivery_info or {}).get('routing_key') or 'unknown'
+    TASK_QUEUE_WAIT_SECONDS.labels(task.name, queue).observe(max(0.0, time.time() - ready_at))
+
 
+@task_postrun.connect
+def observe_task_runtime(task_id=None, task=None, state=None, **kwargs):
+    """
+    Record how long the task ran, by its final state (SUCCESS, FAILURE,
+    RETRY, ...).
+    """
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_RUNTIME_SECONDS.labels(task.name, state or 'UNKNOWN').observe(time.perf_counter() - started)
@@ -7,21 +7,61 @@ construct the broker URL from environment variables.
 The Celery configuration is defined as a dictionary with the
 following keys:
 - broker_url: the URL of the RabbitMQ broker
-- result_backend: the backend used for storing the results of tasks
+- result_backend: the backend used for storing the results of tasks,
+  selected by settings.task_result_backend (database, rpc or redis)
+- result_expires: how long results are kept in the backend
+- result_serializer: compressed JSON when settings.result_compression is set
+- task_ignore_result: do not store results unless a task asks for it
 - imports: a list of modules to import when the Celery worker starts
+- task_queues, task_routes: every API task type has its own RabbitMQ
+  priority queue (celery.weather, celery.event), everything else uses the
+  default celery queue. The celery. prefix keeps them apart from the
+  plain weather queue of part-2 on a shared broker, which is declared
+  without x-max-priority. A worker consumes all of them unless started
+  with -Q, so separate deployments can run e.g. `worker -Q celery.weather`
+  and `worker -Q celery.event` with their own concurrency
+- beat_schedule: periodic tasks run by celery beat (TaskResults retention)
 
 The values of these keys are set to the appropriate values for the
 Celery lab application.
 """
 
-from app.utils.connection_builder import build_broker_url, build_engine_url
+from kombu import Exchange, Queue
+
+from app.celery.serializers import COMPRESSED_JSON
+from app.core.config import settings
+from app.utils.connection_builder import build_broker_url, build_result_backend_url
 
 broker_url = build_broker_url()
-result_backend = build_engine_url(prefix='db+postgresql+psycopg2')
+result_backend = build_result_backend_url(settings.task_result_backend, settings.task_result_backend_url)
+result_expires = settings.result_expires
+task_ignore_result = settings.task_ignore_result
 imports = ('app.celery.tasks',)
 
+_priority_arguments = {'x-max-priority': settings.task_queue_max_priority}
+task_queues = (
+    Queue('celery', Exchange('celery'), routing_key='celery'),
+    Queue('celery.weather', Exchange('celery.weather'), routing_key='celery.weather',
+          queue_arguments=_priority_arguments),
+    Queue('celery.event', Exchange('celery.event'), routing_key='celery.event',
+          queue_arguments=_priority_arguments),
+)
+task_routes = {
+    'app.celery.tasks.make_api_request_weather': {'queue': 'celery.weather', 'routing_key': 'celery.weather'},
+    'app.celery.tasks.make_api_request_event': {'queue': 'celery.event', 'routing_key': 'celery.event'},
+}
+task_default_priority = settings.task_default_priority
+
 task_serializer = 'json'
-result_serializer = 'json'
+result_serializer = COMPRESSED_JSON if settings.result_compression else 'json'
 accept_content = ['json']
+result_accept_content = ['json', COMPRESSED_JSON]
 timezone = 'UTC'
 enable_utc = True
+
+beat_schedule = {
+    'purge-task-results': {
+        'task': 'app.celery.tasks.purge_task_results',
+        'schedule': settings.task_results_purge_interval,
+    },
+}
@@ -0,0 +1,76 @@
+from uuid import uuid4
+
+from celery import Task, states
+
+from app.core.cache import INFLIGHT_PREFIX, build_cache_key, get_cache_backend
+from app.core.config import settings
+
+
+def build_inflight_key(endpoint: str, json_data: dict) -> str:
+    """
+    Build the key under which the in-flight task for a query is registered.
+
+    :param endpoint: The upstream endpoint name, e.g. "weather"
+    :param json_data: The query parameters sent to the upstream API
+    :return: The in-flight key
+    """
+    return f'{INFLIGHT_PREFIX}{build_cache_key(endpoint, json_data)}'
+
+
+class CoalescedTask(Task):
+    """
+    Base class for tasks submitted through submit_coalesced.
+
+    Subclasses set the endpoint attribute; once the task returns, its
+    in-flight key is released so the next identical query enqueues a new task.
+    A retry keeps the key, the query is still in flight.
+    """
+    endpoint: str = None
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        backend = get_cache_backend()
+        if backend is None or status == states.RETRY or 'json_data' not in kwargs:
+            return
+
+        key = build_inflight_key(self.endpoint, kwargs['json_data'])
+        inflight = backend.get(key)
+        if inflight is not None and inflight['task_id'] == task_id:
+            backend.delete(key)
+
+
+def submit_coalesced(task: CoalescedTask, json_data: dict, priority: int | None = None) -> str:
+    """
+    Enqueue the task unless an identical query is already in flight.
+
+    The in-flight key is registered in the cache backend for at most
+    settings.coalesce_ttl seconds. With the shared database backend it is
+    released by the worker as soon as the task finishes; with the in-memory
+    backend the worker cannot reach the API's memory, so duplicates are
+    folded into the first task until the TTL runs out.
+
+    :param task: The task to enqueue
+    :param json_data: The query parameters sent to the upstream API
+    :param priority: The message priority, from 0 (lowest) to
+        settings.task_queue_max_priority; None uses settings.task_default_priority.
+        A query joining a task already in flight keeps that task's priority.
+    :return: The ID of the new task, or of the task already in flight
+    """
+    backend = get_cache_backend()
+    if backend is None:
+        return task.apply_async(kwargs={'json_data': json_data}, priority=priority).id
+
+    key = build_inflight_key(task.endpoint, json_data)
+    task_id = str(uuid4())
+    if not backend.add(key, {'task_id': task_id}, settings.coalesce_ttl):
+        inflight = backend.get(key)
+        if inflight is not None:
+            return inflight['task_id']
+        if not backend.add(key, {'task_id': task_id}, settings.coalesce_ttl):
+            return task.apply_async(kwargs={'json_data': json_data}, priority=priority).id
+
+    try:
+        task.apply_async(kwargs={'json_data': json_data}, task_id=task_id, priority=priority)
+    except Exception:
+        backend.delete(key)
+        raise
+    return task_id
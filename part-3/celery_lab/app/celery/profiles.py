@@ -0,0 +1,67 @@
+"""
+Named worker profiles, selected with settings.worker_profile.
+
+A profile is a set of Celery settings applied on top of celeryconfig:
+
+- default: Celery's defaults (prefork pool, one process per CPU, prefetch
+  multiplier 4, early acks). Kept for comparison.
+- io-bound: for the make_api_request_* tasks, which spend nearly all of
+  their time waiting on HTTP. A thread pool with high concurrency keeps many
+  requests in flight from one process, without the memory of one process
+  per slot. gevent or eventlet can replace threads (-P gevent) when
+  installed; the tasks only use blocking requests, so either works after
+  monkey-patching. Acks are late so a lost worker does not lose tasks.
+  Task messages stay uncompressed, as they only carry a short query; the
+  responses travel as results, which settings.result_compression
+  compresses on the redis and rpc backends. Keep db_pool_size +
+  db_max_overflow near worker_concurrency when the database cache backend
+  is used, or threads queue up for connections.
+- cpu-bound: for tasks that burn CPU. Prefork with one process per CPU,
+  prefetch multiplier 1 so long tasks are not stuck behind each other in
+  one process's buffer, and processes recycled after a fixed number of
+  tasks to bound memory growth.
+
+Per-task rate limits from settings.task_rate_limits apply to every profile.
+"""
+from app.core.config import settings
+
+WORKER_PROFILES = {
+    'default': {},
+    'io-bound': {
+        'worker_pool': 'threads',
+        'worker_concurrency': 64,
+        'worker_prefetch_multiplier': 4,
+        'task_acks_late': True,
+        'task_reject_on_worker_lost': True,
+    },
+    'cpu-bound': {
+        'worker_pool': 'prefork',
+        'worker_concurrency': None,
+        'worker_prefetch_multiplier': 1,
+        'task_acks_late': True,
+        'task_reject_on_worker_lost': True,
+        'worker_max_tasks_per_child': 1000,
+    },
+}
+
+
+def build_worker_config(profile: str) -> dict:
+    """
+    Build the Celery settings of a worker profile, including the per-task
+    rate limits.
+
+    :param profile: The name of the profile, see WORKER_PROFILES
+    :return: The Celery settings to apply
+    """
+    if profile not in WORKER_PROFILES:
+        raise ValueError(f'Unknown worker profile: {profile}')
+
+    config = dict(WORKER_PROFILES[profile])
+    if settings.worker_concurrency is not None:
+        config['worker_concurrency'] = settings.worker_concurrency
+    if settings.task_rate_limits:
+        config['task_annotations'] = {
+            f'app.celery.tasks.{task}': {'rate_limit': rate_limit}
+            for task, rate_limit in settings.task_rate_limits.items()
+        }
+    return config
@@ -0,0 +1,318 @@
+import asyncio
+import contextlib
+import logging
+from collections.abc import AsyncIterator, Iterable
+
+from celery import states
+from celery.backends.base import KeyValueStoreBackend
+from celery.backends.database import DatabaseBackend, session_cleanup
+from celery.backends.redis import RedisBackend
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.celery.celery_app import celery_app
+from app.core.config import settings
+from app.core.db import async_engine
+from app.crud import aget_task_results_by_taskids
+from app.models import TaskResults
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # the redis extra is not installed
+    aioredis = None
+
+LOGGER = logging.getLogger(__name__)
+
+_redis_listener = None
+
+
+def format_task_status(task_id: str, status: str, result=None, error: str | None = None) -> dict:
+    """
+    Build the task status returned by the API.
+
+    :param task_id: The ID of the task
+    :param status: The Celery state of the task
+    :param result: The return value, included when the task succeeded
+    :param error: The error, included when the task failed
+    :return: The task status
+    """
+    response = {"task_id": task_id, "status": status}
+    if status == states.SUCCESS:
+        response["result"] = result
+    elif status in states.PROPAGATE_STATES and error:
+        response["error"] = error
+    return response
+
+
+def get_task_metas(task_ids: Iterable[str]) -> dict[str, dict]:
+    """
+    Fetch the meta-data of many tasks from the Celery result backend with a
+    single round trip where the backend allows it: one SELECT for the
+    database backend, one MGET for key-value backends, and one lookup per
+    task otherwise.
+
+    This does blocking I/O; call it through run_in_threadpool from async code.
+
+    :param task_ids: The IDs of the tasks
+    :return: The meta-data of every task, keyed by task ID; tasks the
+        backend does not know are PENDING
+    """
+    task_ids = list(dict.fromkeys(task_ids))
+    backend = celery_app.backend
+
+    if isinstance(backend, DatabaseBackend):
+        session = backend.ResultSession()
+        with session_cleanup(session):
+            rows = session.query(backend.task_cls).filter(backend.task_cls.task_id.in_(task_ids))
+            found = {row.task_id: backend.meta_from_decoded(row.to_dict()) for row in rows}
+    elif isinstance(backend, KeyValueStoreBackend):
+        values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+        found = {task_id: backend.decode_result(value)
+                 for task_id, value in zip(task_ids, values) if value}
+    else:
+        found = {task_id: backend.get_task_meta(task_id) for task_id in task_ids}
+
+    pending = {'status': states.PENDING, 'result': None}
+    return {task_id: found.get(task_id, pending) for task_id in task_ids}
+
+
+async def get_task_statuses(session: AsyncSession, task_ids: list[str]) -> dict[str, dict]:
+    """
+    Get the status of many tasks without blocking the event loop.
+
+    TaskResults are read in one query through the async session; the tasks
+    not found there are fetched from the Celery result backend in one batch
+    on the thread pool.
+
+    :param session: The async session to use for the database operations
+    :param task_ids: The IDs of the tasks
+    :return: The status of every task, keyed by task ID
+    """
+    stored: dict[str, TaskResults] = await aget_task_results_by_taskids(session, task_ids)
+    statuses = {
+        task_id: format_task_status(task_id, task_result.status, task_result.result, task_result.error)
+        for task_id, task_result in stored.items()
+    }
+
+    missing = [task_id for task_id in task_ids if task_id not in statuses]
+    if missing:
+        metas = await run_in_threadpool(get_task_metas, missing)
+        for task_id, meta in metas.items():
+            error = str(meta['result']) if meta['status'] in states.PROPAGATE_STATES else None
+            statuses[task_id] = format_task_status(task_id, meta['status'], meta['result'], error)
+
+    return {task_id: statuses[task_id] for task_id in task_ids}
+
+
+async def poll_task_statuses(task_ids: list[str]) -> dict[str, dict]:
+    """
+    Get the status of the tasks in a session of their own, closed before
+    returning, so a waiting request holds no database connection between
+    polls and every poll reads the rows afresh.
+
+    :param task_ids: The IDs of the tasks
+    :return: The status of every task, keyed by task ID
+    """
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        return await get_task_statuses(session, task_ids)
+
+
+async def watch_task_statuses(task_ids: list[str], timeout: float) -> AsyncIterator[dict[str, dict]]:
+    """
+    Yield the status of the tasks every time one of them changes, until all
+    of them are ready or the timeout runs out.
+
+    The backend is polled on the server, starting at
+    settings.task_status_poll_interval and backing off to
+    settings.task_status_poll_interval_max, so clients hold one request open
+    instead of polling in a tight loop. Each poll uses a short-lived session
+    (see poll_task_statuses), so waiters do not tie up the connection pool.
+
+    :param task_ids: The IDs of the tasks
+    :param timeout: The maximum seconds to wait, capped at settings.task_status_wait_max
+    :return: An async iterator of the statuses, keyed by task ID
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(timeout, settings.task_status_wait_max)
+    interval = settings.task_status_poll_interval
+    previous = None
+
+    while True:
+        statuses = await poll_task_statuses(task_ids)
+        if statuses != previous:
+            yield statuses
+            previous = statuses
+
+        remaining = deadline - loop.time()
+        if remaining <= 0 or all(status['status'] in states.READY_STATES for status in statuses.values()):
+            return
+
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, settings.task_status_poll_interval_max)
+
+
+async def wait_for_task_statuses(task_ids: list[str], timeout: float) -> dict[str, dict]:
+    """
+    Long-poll: return the status of the tasks as soon as all of them are
+    ready, or their current status once the timeout runs out.
+
+    :param task_ids: The IDs of the tasks
+    :param timeout: The maximum seconds to wait, see watch_task_statuses
+    :return: The status of every task, keyed by task ID
+    """
+    statuses = None
+    async for statuses in watch_task_statuses(task_ids, timeout):
+        pass
+    return statuses
+
+
+class RedisResultListener:
+    """
+    Wait for the results the redis result backend publishes, on the event
+    loop.
+
+    One pub/sub connection is shared by every waiter of the process: the
+    channel of a task is subscribed while somebody waits for it, and a
+    reader task hands each published result to the futures waiting for it.
+    The result consumer behind AsyncResult.get is not used: it blocks a
+    thread per waiter and is not safe to share between threads.
+    """
+
+    def __init__(self, backend: RedisBackend):
+        self._backend = backend
+        # The reader blocks until a result is published, however long that takes.
+        connparams = dict(backend.connparams, socket_timeout=None)
+        if 'connection_class' in connparams:
+            connparams['connection_class'] = getattr(aioredis.connection, connparams['connection_class'].__name__)
+        self._client = aioredis.Redis(**connparams)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._waiters: dict[bytes, set[asyncio.Future]] = {}
+        self._lock = asyncio.Lock()
+        self._reader: asyncio.Task | None = None
+        self.loop = asyncio.get_running_loop()
+        self.closed = False
+
+    async def wait(self, task_id: str, timeout: float) -> dict | None:
+        """
+        Wait until the backend stores a ready result for the task.
+
+        :param task_id: The ID of the task
+        :param timeout: The maximum seconds to wait
+        :return: The meta-data of the task, or None if it is not ready in time
+        :raises redis.RedisError: When the connection to redis fails
+        """
+        key = self._backend.get_key_for_task(task_id)
+        future = self.loop.create_future()
+        await self._add_waiter(key, future)
+        try:
+            # Subscribed before reading the key, so a result stored in between is not missed.
+            self._resolve(key, await self._client.get(key))
+            return await asyncio.wait_for(future, timeout)
+        except TimeoutError:
+            return None
+        finally:
+            await self._remove_waiter(key, future)
+
+    async def _add_waiter(self, key: bytes, future: asyncio.Future):
+        async with self._lock:
+            waiters = self._waiters.setdefault(key, set())
+            waiters.add(future)
+            if len(waiters) == 1:
+                try:
+                    await self._pubsub.subscribe(key)
+                except BaseException:
+                    del self._waiters[key]
+                    raise
+            if self._reader is None:
+                self._reader = asyncio.create_task(self._read())
+
+    async def _remove_waiter(self, key: bytes, future: asyncio.Future):
+        async with self._lock:
+            waiters = self._waiters.get(key, set())
+            waiters.discard(future)
+            if waiters or self.closed:
+                return
+            self._waiters.pop(key, None)
+            with contextlib.suppress(aioredis.RedisError, OSError):
+                await self._pubsub.unsubscribe(key)
+
+    def _resolve(self, key: bytes, value):
+        if not value:
+            return
+        futures = [future for future in self._waiters.get(key, ()) if not future.done()]
+        try:
+            meta = self._backend.decode_result(value)
+        except Exception as exc:
+            for future in futures:
+                future.set_exception(exc)
+            return
+        if meta['status'] in states.READY_STATES:
+            for future in futures:
+                future.set_result(meta)
+
+    async def _read(self):
+        try:
+            while True:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                if message is not None:
+                    self._resolve(message['channel'], message['data'])
+        except Exception as exc:
+            LOGGER.warning('Lost the redis result subscription: %s', exc)
+            self.closed = True
+            for waiters in self._waiters.values():
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(exc)
+            with contextlib.suppress(aioredis.RedisError, OSError):
+                await self._pubsub.aclose()
+                await self._client.aclose()
+
+
+def get_redis_result_listener() -> RedisResultListener:
+    """
+    Get the result listener of the running event loop, replacing one whose
+    connection was lost.
+
+    :return: The listener
+    """
+    global _redis_listener
+
+    loop = asyncio.get_running_loop()
+    if _redis_listener is None or _redis_listener.closed or _redis_listener.loop is not loop:
+        _redis_listener = RedisResultListener(celery_app.backend)
+    return _redis_listener
+
+
+async def wait_for_task(task_id: str, timeout: float) -> dict:
+    """
+    Wait until a task is ready or the timeout runs out, and return its status.
+
+    The redis backend publishes every result, so the wait is a future
+    resolved by the notification, awaited on the event loop without holding
+    a thread pool slot (see RedisResultListener). The other backends, and
+    redis when its connection fails, fall back to the backoff poll of
+    watch_task_statuses: the database backend has no notifications, and the
+    rpc backend replies to a queue of the thread that sent the task, which
+    is not the one that waits for it.
+
+    :param task_id: The ID of the task
+    :param timeout: The maximum seconds to wait, capped at settings.task_status_wait_max
+    :return: The status of the task; PENDING if it is not ready in time
+    """
+    timeout = min(timeout, settings.task_status_wait_max)
+    if isinstance(celery_app.backend, RedisBackend):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            meta = await get_redis_result_listener().wait(task_id, timeout)
+        except (aioredis.RedisError, OSError) as exc:
+            LOGGER.warning('Polling for task %s, the redis result subscription failed: %s', task_id, exc)
+            timeout = max(deadline - loop.time(), 0)
+        else:
+            if meta is None:
+                return format_task_status(task_id, states.PENDING)
+            error = str(meta['result']) if meta['status'] in states.PROPAGATE_STATES else None
+            return format_task_status(task_id, meta['status'], meta['result'], error)
+
+    statuses = await wait_for_task_statuses([task_id], timeout)
+    return statuses[task_id]
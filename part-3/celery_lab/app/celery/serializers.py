@@ -0,0 +1,30 @@
+import zlib
+
+from kombu.serialization import register
+from kombu.utils.json import dumps, loads
+
+COMPRESSED_JSON = 'json-zlib'
+
+
+def dumps_compressed(obj) -> bytes:
+    """
+    Serialize to JSON with the Celery encoders and compress with zlib.
+
+    :param obj: The object to serialize
+    :return: The compressed payload
+    """
+    return zlib.compress(dumps(obj).encode('utf-8'))
+
+
+def loads_compressed(data: bytes):
+    """
+    Decompress and deserialize a payload written by dumps_compressed.
+
+    :param data: The compressed payload
+    :return: The deserialized object
+    """
+    return loads(zlib.decompress(data))
+
+
+register(COMPRESSED_JSON, dumps_compressed, loads_compressed,
+         content_type='application/x-json-zlib', content_encoding='binary')
@@ -1,44 +1,124 @@
+import logging
+from collections.abc import Callable
+from datetime import UTC, datetime, timedelta
 from typing import Any
 
 import requests
+from sqlmodel import Session
 
+from app import crud
+from app.core.cache import cache_response, get_cached_response, get_stale_response
 from app.core.config import settings
+from app.core.db import engine
+from app.core.metrics import UPSTREAM_REQUEST_SECONDS
+from app.utils import get_session
+from app.utils.resilience import CircuitOpenError, UpstreamError, guarded_request
 from .celery_app import celery_app
+from .coalescing import CoalescedTask
 
+LOGGER = logging.getLogger(__name__)
 
-@celery_app.task()
+UPSTREAM_RETRY = {
+    'autoretry_for': (requests.RequestException, UpstreamError, CircuitOpenError),
+    'retry_backoff': True,
+    'retry_backoff_max': settings.upstream_retry_backoff_max,
+    'retry_jitter': True,
+    'max_retries': settings.upstream_max_retries,
+}
+
+
+def fetch_upstream(endpoint: str, upstream: str, json_data: dict,
+                   request: Callable[[], requests.Response]) -> dict[str, Any]:
+    """
+    Serve the query from the cache, or call the upstream through its rate
+    limiter and circuit breaker and cache a successful response.
+
+    While the circuit is open the last good response is served, if there is
+    one; otherwise CircuitOpenError is raised and the task retries with backoff.
+
+    :param endpoint: The endpoint name used for caching, e.g. "weather"
+    :param upstream: The upstream name used for rate limiting, e.g. "weatherapi"
+    :param json_data: The query parameters sent to the upstream API
+    :param request: Makes the request and returns the response
+    :return: The response from the API
+    """
+    cached = get_cached_response(endpoint, json_data)
+    if cached is not None:
+        return cached
+
+    try:
+        with UPSTREAM_REQUEST_SECONDS.labels(upstream).time():
+            response = guarded_request(upstream, request)
+    except CircuitOpenError:
+        stale = get_stale_response(endpoint, json_data)
+        if stale is None:
+            raise
+        LOGGER.warning('Circuit for %s is open, serving a stale response', upstream)
+        return stale
+
+    result = response.json()
+    if response.ok:
+        cache_response(endpoint, json_data, result)
+    return result
+
+
+@celery_app.task(base=CoalescedTask, endpoint='weather', **UPSTREAM_RETRY)
 def make_api_request_weather(json_data: dict) -> dict[str, Any]:
     """
     Make an API request to WeatherAPI.
 
+    Successful responses are cached for the "weather" TTL and served from the
+    cache for repeated queries. Failed calls are retried with backoff, see
+    fetch_upstream.
+
     :param str api_key: The API key to use for the request
     :param dict json_data: The JSON data to use for the request
     :return: The response from the API
     :rtype: dict[str, Any]
     """
-    return requests.get(
-        url='http://api.weatherapi.com/v1/current.json',
+    return fetch_upstream('weather', 'weatherapi', json_data, lambda: get_session().get(
+        url=settings.weather_api_url,
         params={
             'key': settings.api_key_for_weather,
             **json_data
         }
-    ).json()
+    ))
 
 
-@celery_app.task()
+@celery_app.task(base=CoalescedTask, endpoint='event', **UPSTREAM_RETRY)
 def make_api_request_event(json_data: dict) -> dict[str, Any]:
     """
     Make a GET request to the Ticketmaster API to retrieve events for a given city.
 
+    Successful responses are cached for the "event" TTL and served from the
+    cache for repeated queries. Failed calls are retried with backoff, see
+    fetch_upstream.
+
     :param str api_key: The API key to use for the request
     :param dict json_data: The JSON data to use for the request
     :return: The response from the API
     :rtype: dict[str, Any]
     """
-    return requests.get(
-        url='https://app.ticketmaster.com/discovery/v2/events.json',
+    return fetch_upstream('event', 'ticketmaster', json_data, lambda: get_session().get(
+        url=settings.event_api_url,
         params={
             'apikey': settings.api_key_for_event,
             **json_data
         }
-    ).json()
+    ))
+
+
+@celery_app.task(ignore_result=True)
+def purge_task_results() -> int:
+    """
+    Delete TaskResults older than settings.task_results_retention seconds.
+
+    Scheduled by celery beat every settings.task_results_purge_interval
+    seconds, so the table stays flat under constant load.
+
+    :return: The number of deleted rows
+    :rtype: int
+    """
+    older_than = datetime.now(UTC) - timedelta(seconds=settings.task_results_retention)
+    with Session(engine) as session:
+        return crud.purge_task_results(session, older_than, settings.task_results_purge_batch)
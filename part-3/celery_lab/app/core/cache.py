@@ -0,0 +1,282 @@
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from app.core.config import settings
+from app.core.db import engine as app_engine
+from app.models import ResponseCache
+
+# Prefix of the keys submit_coalesced registers in-flight tasks under.
+INFLIGHT_PREFIX = 'inflight:'
+
+
+class CacheBackend(ABC):
+    """
+    A key/value store for upstream API responses.
+
+    shared tells whether every process (API and workers) sees the same
+    entries.
+    """
+    shared: bool = False
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float):
+        pass
+
+    @abstractmethod
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        """
+        Store the value only if the key is absent or expired.
+
+        :return: True if the value was stored, False if the key was taken
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+
+class InMemoryCache(CacheBackend):
+    """
+    A per-process LRU cache with per-entry expiry.
+
+    Once max_entries is reached the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return False
+            self._entries[key] = (value, time.monotonic() + ttl)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DatabaseCache(CacheBackend):
+    """
+    A cache shared by the API and every Celery worker, stored in the
+    ResponseCache table. This is the default backend.
+
+    It runs against the application database by default, or against any
+    SQLAlchemy URL given in cache_database_url (e.g. sqlite:///cache.db as a
+    local stand-in). Expired rows are purged and the table is trimmed to
+    max_entries, least recently used first, every purge_every writes.
+    In-flight keys are left out of the trim, they expire within seconds.
+
+    Reads refresh last_access at most once per access_resolution seconds,
+    so cache hits do not all turn into writes.
+    """
+    shared = True
+    access_resolution: float = 60.0
+
+    def __init__(self, engine, max_entries: int, purge_every: int = 100):
+        self._engine = engine
+        self._max_entries = max_entries
+        self._purge_every = purge_every
+        self._writes = 0
+        SQLModel.metadata.create_all(engine, tables=[ResponseCache.__table__])
+
+    def get(self, key: str) -> Any | None:
+        now = time.time()
+        with Session(self._engine) as session:
+            entry = session.get(ResponseCache, key)
+            if entry is None or entry.expires_at <= now:
+                return None
+            value = entry.value
+            if entry.last_access <= now - self.access_resolution:
+                session.execute(update(ResponseCache).where(ResponseCache.key == key).values(last_access=now))
+                session.commit()
+            return value
+
+    def set(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        with Session(self._engine) as session:
+            session.merge(ResponseCache(key=key, value=value, expires_at=now + ttl, last_access=now))
+            session.commit()
+
+            self._writes += 1
+            if self._writes % self._purge_every == 0:
+                self.__purge(session)
+
+    def add(self, key: str, value: Any, ttl: float) -> bool:
+        with Session(self._engine) as session:
+            session.execute(delete(ResponseCache).where(ResponseCache.key == key,
+                                                        ResponseCache.expires_at <= time.time()))
+            now = time.time()
+            session.add(ResponseCache(key=key, value=value, expires_at=now + ttl, last_access=now))
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return False
+            return True
+
+    def delete(self, key: str):
+        with Session(self._engine) as session:
+            session.execute(delete(ResponseCache).where(ResponseCache.key == key))
+            session.commit()
+
+    def __purge(self, session: Session):
+        session.execute(delete(ResponseCache).where(ResponseCache.expires_at <= time.time()))
+
+        cached = ResponseCache.key.not_like(f'{INFLIGHT_PREFIX}%')
+        overflow = session.exec(select(func.count()).where(cached)).one() - self._max_entries
+        if overflow > 0:
+            oldest = select(ResponseCache.key).where(cached).order_by(ResponseCache.last_access).limit(overflow)
+            session.execute(delete(ResponseCache).where(ResponseCache.key.in_(oldest)))
+        session.commit()
+
+
+def build_cache_key(endpoint: str, json_data: dict) -> str:
+    """
+    Build a cache key from the endpoint name and the normalized query.
+
+    String values are stripped and lower-cased and keys are sorted, so
+    "Paris", " paris" and "PARIS" share one entry.
+
+    :param endpoint: The upstream endpoint name, e.g. "weather"
+    :param json_data: The query parameters sent to the upstream API
+    :return: The cache key
+    """
+    normalized = {key: value.strip().lower() if isinstance(value, str) else value
+                  for key, value in json_data.items()}
+    return f'{endpoint}:{json.dumps(normalized, sort_keys=True, ensure_ascii=False)}'
+
+
+def build_cache_backend() -> CacheBackend | None:
+    """
+    Build the cache backend selected by settings.cache_backend.
+
+    :return: The cache backend, or None if caching is disabled
+    """
+    if settings.cache_backend == 'memory':
+        return InMemoryCache(max_entries=settings.cache_max_entries)
+    if settings.cache_backend == 'database':
+        engine = create_engine(settings.cache_database_url) if settings.cache_database_url else app_engine
+        return DatabaseCache(engine, max_entries=settings.cache_max_entries)
+    if settings.cache_backend == 'none':
+        return None
+    raise ValueError(f'Unknown cache backend: {settings.cache_backend}')
+
+
+_backend: CacheBackend | None = None
+_backend_lock = threading.Lock()
+_backend_ready = False
+
+
+def get_cache_backend() -> CacheBackend | None:
+    """
+    Get the cache backend of this process, building it on first use.
+
+    :return: The cache backend, or None if caching is disabled
+    """
+    global _backend, _backend_ready
+
+    if not _backend_ready:
+        with _backend_lock:
+            if not _backend_ready:
+                _backend = build_cache_backend()
+                _backend_ready = True
+    return _backend
+
+
+def is_cache_shared() -> bool:
+    """
+    Tell whether responses cached by the workers are visible to this
+    process. Only then can the API answer from the cache; with the
+    per-process memory backend its lookups would always miss.
+
+    :return: True if the cache backend is shared between processes
+    """
+    backend = get_cache_backend()
+    return backend is not None and backend.shared
+
+
+def get_cached_response(endpoint: str, json_data: dict) -> dict[str, Any] | None:
+    """
+    Get a cached upstream response for the query.
+
+    :param endpoint: The upstream endpoint name, e.g. "weather"
+    :param json_data: The query parameters sent to the upstream API
+    :return: The cached response, or None on a miss
+    """
+    backend = get_cache_backend()
+    if backend is None:
+        return None
+    return backend.get(build_cache_key(endpoint, json_data))
+
+
+def get_stale_response(endpoint: str, json_data: dict) -> dict[str, Any] | None:
+    """
+    Get the last good upstream response for the query, even if its TTL has
+    passed. Served while the upstream's circuit is open.
+
+    :param endpoint: The upstream endpoint name, e.g. "weather"
+    :param json_data: The query parameters sent to the upstream API
+    :return: The stale response, or None if there is none
+    """
+    backend = get_cache_backend()
+    if backend is None:
+        return None
+    return backend.get(f'stale:{build_cache_key(endpoint, json_data)}')
+
+
+def cache_response(endpoint: str, json_data: dict, response: dict[str, Any]):
+    """
+    Store an upstream response for the endpoint's configured TTL, and a
+    stale copy for settings.stale_cache_ttl.
+
+    :param endpoint: The upstream endpoint name, e.g. "weather"
+    :param json_data: The query parameters sent to the upstream API
+    :param response: The upstream response to cache
+    """
+    backend = get_cache_backend()
+    ttl = settings.cache_ttl.get(endpoint, 0)
+    if backend is None or ttl <= 0:
+        return
+    key = build_cache_key(endpoint, json_data)
+    # The stale copy is written first, so an LRU trim drops it before the fresh entry.
+    if settings.stale_cache_ttl > ttl:
+        backend.set(f'stale:{key}', response, settings.stale_cache_ttl)
+    backend.set(key, response, ttl)
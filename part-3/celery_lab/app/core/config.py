@@ -1,5 +1,3 @@
-from functools import cached_property
-
 from pydantic import computed_field
 from pydantic_settings import BaseSettings
 
@@ -7,13 +5,63 @@ from app.utils.vault_helper import vault_helper
 
 
 class Settings(BaseSettings):
+    vault_prefetch: bool = True
+
+    db_echo: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+
+    cache_backend: str = 'database'
+    cache_database_url: str | None = None
+    cache_max_entries: int = 1024
+    cache_ttl: dict[str, int] = {'weather': 300, 'event': 3600}
+    coalesce_ttl: int = 60
+    stale_cache_ttl: int = 24 * 3600
+
+    weather_api_url: str = 'http://api.weatherapi.com/v1/current.json'
+    event_api_url: str = 'https://app.ticketmaster.com/discovery/v2/events.json'
+    upstream_max_retries: int = 5
+    upstream_retry_backoff_max: int = 60
+
+    persist_task_results: bool = False
+    task_results_batch_size: int = 500
+    task_results_flush_interval: float = 1.0
+    task_results_retention: int = 7 * 24 * 3600
+    task_results_purge_interval: int = 3600
+    task_results_purge_batch: int = 5000
+
+    # Not result_backend: the celery CLI reads RESULT_BACKEND from the
+    # environment as a backend URL, and 'database' is not one.
+    task_result_backend: str = 'database'
+    task_result_backend_url: str | None = None
+    result_expires: int = 24 * 3600
+    result_compression: bool = False
+    task_ignore_result: bool = False
+
+    task_queue_max_priority: int = 9
+    task_default_priority: int = 5
+
+    worker_profile: str = 'default'
+    worker_concurrency: int | None = None
+    task_rate_limits: dict[str, str] = {}
+
+    task_status_batch_max: int = 100
+    task_status_wait_max: float = 30
+    task_status_poll_interval: float = 0.1
+    task_status_poll_interval_max: float = 1.0
+
+    worker_metrics_port: int | None = None
+
     @computed_field
-    @cached_property
+    @property
     def api_key_for_weather(self) -> str:
         return vault_helper.get_api_key(alias='weather-api-key')
 
     @computed_field
-    @cached_property
+    @property
     def api_key_for_event(self) -> str:
         return vault_helper.get_api_key(alias='event-api-key')
 
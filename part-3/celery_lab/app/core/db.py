@@ -1,8 +1,39 @@
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine, SQLModel
 
+from app.core.config import settings
 from app.utils import build_engine_url
 
-engine = create_engine(build_engine_url(), echo=True)
+
+def build_engine_options() -> dict:
+    """
+    Build the engine options shared by the sync and async engines.
+
+    Pool sizing, pre-ping, recycling and SQL echo are taken from
+    :py:data:`app.core.config.settings` (DB_* environment variables).
+
+    :return: Keyword arguments for create_engine/create_async_engine
+    :rtype: dict
+    """
+    return {
+        'echo': settings.db_echo,
+        'pool_size': settings.db_pool_size,
+        'max_overflow': settings.db_max_overflow,
+        'pool_timeout': settings.db_pool_timeout,
+        'pool_recycle': settings.db_pool_recycle,
+        'pool_pre_ping': settings.db_pool_pre_ping,
+    }
+
+
+engine = create_engine(build_engine_url(), **build_engine_options())
+async_engine = create_async_engine(build_engine_url(prefix='postgresql+asyncpg'), **build_engine_options())
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'migrations'
+
+# Serializes the migrations of API processes starting at the same time.
+MIGRATIONS_LOCK_ID = 0x7461736b
 
 
 def create_db_and_tables():
@@ -13,9 +44,28 @@ def create_db_and_tables():
     :py:mod:`app.models`.
 
     It uses the :py:func:`sqlmodel.metadata.create_all` function to create the
-    tables in the database.
+    tables in the database, then upgrades existing tables with
+    :py:func:`apply_migrations`.
 
     :param engine: The database engine to use for creating the tables.
     :type engine: :py:class:`sqlalchemy.engine.Engine`
     """
     SQLModel.metadata.create_all(engine)
+    apply_migrations()
+
+
+def apply_migrations():
+    """
+    Upgrade tables created by earlier versions of the models.
+
+    create_all does not alter existing tables, so every change to an
+    existing table ships as an idempotent SQL script in app/migrations.
+    All scripts are run in name order, in one transaction, on every start.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'SELECT pg_advisory_xact_lock({MIGRATIONS_LOCK_ID})')
+        for script in sorted(MIGRATIONS_DIR.glob('*.sql')):
+            connection.exec_driver_sql(script.read_text())
@@ -0,0 +1,94 @@
+import logging
+import os
+import time
+from collections.abc import Awaitable, Callable
+
+from fastapi import Request, Response
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram, make_asgi_app, multiprocess, start_http_server
+
+LOGGER = logging.getLogger(__name__)
+
+TASK_RUNTIME_SECONDS = Histogram(
+    'celery_task_runtime_seconds',
+    'Time a Celery task spends executing on the worker',
+    ['task', 'state'])
+
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    'celery_task_queue_wait_seconds',
+    'Time from publishing a Celery task (or its ETA) until a worker starts it',
+    ['task', 'queue'])
+
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    'upstream_request_seconds',
+    'Time spent calling an upstream API, including the rate limiter wait',
+    ['upstream'])
+
+HTTP_REQUEST_DURATION_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Time until the API starts its response, by route template',
+    ['method', 'route', 'status'])
+
+
+def build_registry() -> CollectorRegistry:
+    """
+    Get the registry to export.
+
+    Prefork Celery workers and multi-process uvicorn record metrics in
+    several processes; for those, set PROMETHEUS_MULTIPROC_DIR to an empty
+    directory before the processes start, and the exported registry
+    aggregates the values of every process.
+
+    :return: The registry
+    """
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def start_metrics_server(port: int):
+    """
+    Serve /metrics from a background thread, e.g. in a Celery worker.
+
+    :param port: The port to listen on
+    """
+    start_http_server(port, registry=build_registry())
+    LOGGER.info('Serving metrics on port %i', port)
+
+
+def mark_process_dead(pid: int):
+    """
+    Remove the live gauges of a process that exited from
+    PROMETHEUS_MULTIPROC_DIR, when it is set.
+
+    :param pid: The ID of the process
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
+
+
+def make_metrics_app():
+    """
+    Build the ASGI app serving /metrics from the API.
+    """
+    return make_asgi_app(registry=build_registry())
+
+
+async def observe_request_duration(request: Request,
+                                   call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    """
+    HTTP middleware recording the latency of every request under its route
+    template, e.g. /api/task/{task_id}, so the label stays bounded.
+    """
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        HTTP_REQUEST_DURATION_SECONDS.labels(
+            request.method, getattr(route, 'path', 'unmatched'), status).observe(time.perf_counter() - started)
@@ -0,0 +1,101 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlmodel import Session
+
+from app.core.config import settings
+from app.core.db import engine
+from app.crud import create_task_results_bulk
+from app.models import TaskResults
+
+LOGGER = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class TaskResultWriter:
+    """
+    Buffers TaskResults and writes them with create_task_results_bulk from a
+    background thread, once batch_size results are collected or
+    flush_interval seconds have passed, whichever comes first.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int = 10000):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name='task-result-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, task_result: TaskResults):
+        """
+        Queue a TaskResult for the next flush. Blocks while the queue is full.
+
+        :param task_result: The TaskResult to write
+        """
+        self._queue.put(task_result)
+
+    def close(self):
+        """
+        Flush the queued TaskResults and stop the background thread.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self._batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self._flush_interval
+
+    def _flush(self, batch: list[TaskResults]):
+        if not batch:
+            return
+        try:
+            with Session(engine) as session:
+                create_task_results_bulk(session, batch)
+        except Exception:
+            LOGGER.exception('Failed to write %d task results', len(batch))
+
+
+_writer: TaskResultWriter | None = None
+_writer_pid: int | None = None
+_writer_lock = threading.Lock()
+
+
+def get_task_result_writer() -> TaskResultWriter:
+    """
+    Get the TaskResultWriter of this process, created on first use and
+    re-created after a fork. It is flushed when the process exits.
+
+    :return: The TaskResultWriter
+    """
+    global _writer, _writer_pid
+
+    pid = os.getpid()
+    if _writer is None or _writer_pid != pid:
+        with _writer_lock:
+            if _writer is None or _writer_pid != pid:
+                _writer = TaskResultWriter(batch_size=settings.task_results_batch_size,
+                                           flush_interval=settings.task_results_flush_interval)
+                _writer_pid = pid
+                atexit.register(_writer.close)
+    return _writer
@@ -1,4 +1,10 @@
+from collections.abc import Iterable
+from datetime import datetime
+
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.models import TaskResults
 
@@ -14,6 +20,43 @@ def create_task_result(session: Session, task_result: TaskResults):
     session.commit()
 
 
+def create_task_results_bulk(session: Session, task_results: Iterable[TaskResults]):
+    """
+    Create or update many TaskResults in one multi-row INSERT and one commit.
+
+    Rows whose task_id already exists are updated in place (upsert). If the
+    same task_id appears more than once, the last occurrence wins.
+
+    :param session: The session to use for the database operations
+    :param task_results: The TaskResults to write to the database
+    """
+    rows = {
+        task_result.task_id: {
+            'task_id': task_result.task_id,
+            'status': task_result.status,
+            'result': task_result.result,
+            'error': task_result.error,
+            'query_key': task_result.query_key,
+        }
+        for task_result in task_results
+    }
+    if not rows:
+        return
+
+    statement = insert(TaskResults).values(list(rows.values()))
+    statement = statement.on_conflict_do_update(
+        index_elements=[TaskResults.task_id],
+        set_={
+            'status': statement.excluded.status,
+            'result': statement.excluded.result,
+            'error': statement.excluded.error,
+            'query_key': statement.excluded.query_key,
+        },
+    )
+    session.exec(statement)
+    session.commit()
+
+
 def get_task_result_by_taskid(session: Session, task_id: str):
     """
     Get a TaskResult from the database by its task ID.
@@ -26,3 +69,63 @@ def get_task_result_by_taskid(session: Session, task_id: str):
     statement = select(TaskResults).where(TaskResults.task_id == task_id)
     task_result = session.exec(statement).one_or_none()
     return task_result
+
+
+def purge_task_results(session: Session, older_than: datetime, batch_size: int) -> int:
+    """
+    Delete TaskResults created before the given time, in batches.
+
+    Each batch is its own short transaction, so the purge never holds locks
+    on a large part of the table.
+
+    :param session: The session to use for the database operations
+    :param older_than: Rows created before this time are deleted
+    :param batch_size: The maximum number of rows deleted per transaction
+
+    :return: The number of deleted rows
+    """
+    deleted = 0
+    while True:
+        expired = (select(TaskResults.id)
+                   .where(TaskResults.created_at < older_than)
+                   .limit(batch_size))
+        count = session.execute(delete(TaskResults).where(TaskResults.id.in_(expired))).rowcount
+        session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+async def aget_task_result_by_taskid(session: AsyncSession, task_id: str):
+    """
+    Get a TaskResult from the database by its task ID without blocking the
+    event loop.
+
+    The row is reloaded even if the session already holds it, so a status
+    that changed since (e.g. RETRY to SUCCESS) is not served stale.
+
+    :param session: The async session to use for the database operations
+    :param task_id: The task ID of the TaskResult to retrieve
+
+    :return: The TaskResult with the given task ID, or None if not found
+    """
+    statement = (select(TaskResults).where(TaskResults.task_id == task_id)
+                 .execution_options(populate_existing=True))
+    task_result = (await session.exec(statement)).one_or_none()
+    return task_result
+
+
+async def aget_task_results_by_taskids(session: AsyncSession, task_ids: Iterable[str]):
+    """
+    Get many TaskResults from the database in one query without blocking
+    the event loop. Rows already in the session are reloaded, see
+    aget_task_result_by_taskid.
+
+    :param session: The async session to use for the database operations
+    :param task_ids: The task IDs of the TaskResults to retrieve
+
+    :return: The TaskResults found, keyed by task ID
+    """
+    statement = (select(TaskResults).where(TaskResults.task_id.in_(list(task_ids)))
+                 .execution_options(populate_existing=True))
+    return {task_result.task_id: task_result for task_result in (await session.exec(statement)).all()}
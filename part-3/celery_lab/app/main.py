@@ -1,19 +1,28 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
-from app.core.db import create_db_and_tables, engine
+from app.core.config import settings
+from app.core.db import async_engine, create_db_and_tables, engine
+from app.core.metrics import make_metrics_app, observe_request_duration
+from app.utils.vault_helper import vault_helper
 from .api.main import api_router
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    if settings.vault_prefetch:
+        app.state.vault_prefetch = asyncio.create_task(vault_helper.aprefetch())
 
     yield
 
     engine.dispose()
+    await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
+app.middleware('http')(observe_request_duration)
 app.include_router(api_router)
+app.mount('/metrics', make_metrics_app())
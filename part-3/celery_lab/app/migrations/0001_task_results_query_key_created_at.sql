@@ -0,0 +1,24 @@
+-- TaskResults columns and indexes added after the table was first created
+-- (query_key, created_at, the status index and JSONB results).
+-- create_all only creates missing tables, so databases created before the
+-- change are upgraded here. Every statement is a no-op once applied.
+
+ALTER TABLE taskresults ADD COLUMN IF NOT EXISTS query_key VARCHAR;
+
+-- Existing rows get the time of the migration, so the purge task removes
+-- them one retention period after the upgrade.
+ALTER TABLE taskresults ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now();
+
+-- Rewrites the table under an exclusive lock; run it off-peak on large tables.
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'taskresults' AND column_name = 'result') = 'json' THEN
+        ALTER TABLE taskresults ALTER COLUMN result TYPE JSONB USING result::jsonb;
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS ix_taskresults_status ON taskresults (status);
+CREATE INDEX IF NOT EXISTS ix_taskresults_query_key ON taskresults (query_key);
+CREATE INDEX IF NOT EXISTS ix_taskresults_created_at ON taskresults (created_at);
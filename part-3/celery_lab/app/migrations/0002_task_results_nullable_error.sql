@@ -0,0 +1,5 @@
+-- TaskResults.error is empty for successful tasks; tables created while it
+-- was declared as str have it NOT NULL, which rejects every successful row
+-- written by the result writer.
+
+ALTER TABLE taskresults ALTER COLUMN error DROP NOT NULL;
@@ -0,0 +1,8 @@
+-- ResponseCache.last_access, which the database cache trims on (least
+-- recently used first). Existing rows get 0 and are the first to go.
+-- Caches kept in another database (cache_database_url) are not migrated:
+-- drop their responsecache table, it is recreated on start.
+
+ALTER TABLE responsecache ADD COLUMN IF NOT EXISTS last_access DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS ix_responsecache_last_access ON responsecache (last_access);
@@ -1,9 +1,25 @@
-from sqlmodel import SQLModel, Field, JSON
+from datetime import UTC, datetime
+
+from sqlalchemy import JSON, DateTime, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import SQLModel, Field
 
 
 class TaskResults(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     task_id: str = Field(default=None, unique=True)
-    status: str = Field(default=None)
-    result: dict | None = Field(default=None, sa_type=JSON)
-    error: str = Field(default=None)
+    status: str = Field(default=None, index=True)
+    result: dict | None = Field(default=None, sa_type=JSON().with_variant(JSONB(), 'postgresql'))
+    error: str | None = Field(default=None)
+    query_key: str | None = Field(default=None, index=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC),
+                                 sa_type=DateTime(timezone=True),
+                                 sa_column_kwargs={'server_default': func.now()},
+                                 index=True)
+
+
+class ResponseCache(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    value: dict = Field(sa_type=JSON)
+    expires_at: float = Field(index=True)
+    last_access: float = Field(default=0.0, index=True)
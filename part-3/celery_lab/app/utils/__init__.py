@@ -1,3 +1,4 @@
 from .connection_builder import build_engine_url, build_broker_url
+from .http_client import get_session
 
-__all__ = ["build_engine_url", "build_broker_url"]
+__all__ = ["build_engine_url", "build_broker_url", "get_session"]
@@ -0,0 +1,83 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests.Session that applies a default timeout to every request.
+
+    requests has no session-wide timeout, so without this a stalled upstream
+    would hold a worker thread forever.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self._timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return super().request(method, url, **kwargs)
+
+
+def build_session():
+    """
+    Build a pooled, keep-alive HTTP session with retries and backoff.
+
+    The following environment variables are optional:
+    - HTTP_POOL_CONNECTIONS: the number of per-host connection pools to cache (default 10)
+    - HTTP_POOL_MAXSIZE: the number of keep-alive connections kept per host (default 32)
+    - HTTP_CONNECT_TIMEOUT: the connect timeout in seconds (default 3.05)
+    - HTTP_READ_TIMEOUT: the read timeout in seconds (default 10)
+    - HTTP_RETRIES: the number of retries on connection errors and 429/5xx responses (default 3)
+    - HTTP_BACKOFF_FACTOR: the exponential backoff factor between retries (default 0.3)
+
+    :return: The configured session
+    :rtype: requests.Session
+    """
+    retry = Retry(
+        total=int(os.getenv('HTTP_RETRIES', '3')),
+        backoff_factor=float(os.getenv('HTTP_BACKOFF_FACTOR', '0.3')),
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'POST'}),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(os.getenv('HTTP_POOL_CONNECTIONS', '10')),
+        pool_maxsize=int(os.getenv('HTTP_POOL_MAXSIZE', '32')),
+        max_retries=retry,
+    )
+
+    session = TimeoutSession(timeout=(float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05')),
+                                      float(os.getenv('HTTP_READ_TIMEOUT', '10'))))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Get the HTTP session shared by this process.
+
+    The session is created on first use and re-created after a fork, so
+    pooled sockets are never shared between processes.
+
+    :return: The shared session
+    :rtype: requests.Session
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = build_session()
+                _session_pid = pid
+    return _session
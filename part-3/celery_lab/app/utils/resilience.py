@@ -0,0 +1,310 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Documented quotas: Ticketmaster's Discovery API allows 5 requests per second.
+DEFAULT_RATE_LIMITS = {'ticketmaster': 5}
+
+_BUCKET_STATE = struct.Struct('dd')
+
+_rate_limiters = {}
+_circuit_breakers = {}
+_registry_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream whose circuit is open.
+    """
+
+    def __init__(self, name, retry_after):
+        super().__init__(name, retry_after)
+        self.name = name
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f'Circuit for {self.name} is open, retry in {self.retry_after:.1f} seconds'
+
+
+class UpstreamError(Exception):
+    """
+    Raised when an upstream answers with a status worth retrying (429, 5xx).
+    """
+
+    def __init__(self, name, status_code):
+        super().__init__(name, status_code)
+        self.name = name
+        self.status_code = status_code
+
+    def __str__(self):
+        return f'{self.name} answered HTTP {self.status_code}'
+
+
+class TokenBucket:
+    def __init__(self, name, rate, capacity=None, directory=None):
+        """
+        A token bucket shared by every process on the host.
+
+        The bucket state (tokens, last refill time) lives in a small file
+        guarded by flock, so worker threads and forked consumer processes
+        draw from the same budget.
+
+        :param str name: The bucket name, one file per name
+        :param float rate: The tokens added per second
+        :param float capacity: The maximum burst, defaults to rate (at least 1)
+        :param str directory: Where the bucket file is kept, defaults to the temp directory
+        """
+        self._name = name
+        self._rate = rate
+        self._capacity = max(1.0, capacity or rate)
+        self._path = os.path.join(directory or tempfile.gettempdir(), f'{name}.bucket')
+
+    def acquire(self, timeout=None):
+        """
+        Take one token, sleeping until one is available.
+
+        :param float timeout: The maximum seconds to wait, None waits forever
+        :rtype: bool
+        :return: True once a token was taken, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    async def aacquire(self):
+        """
+        Take one token, sleeping on the event loop until one is available.
+        """
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Refill the bucket and take a token if there is one.
+
+        :rtype: float
+        :return: 0 if a token was taken, else the seconds until the next one
+        """
+        # The file is opened on every call: flock belongs to the open file
+        # description, which a forked child would otherwise share.
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, _BUCKET_STATE.size, 0)
+            now = time.time()
+            if len(data) == _BUCKET_STATE.size:
+                tokens, updated = _BUCKET_STATE.unpack(data)
+                tokens = min(self._capacity, tokens + max(0.0, now - updated) * self._rate)
+            else:
+                tokens = self._capacity
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self._rate
+            os.pwrite(fd, _BUCKET_STATE.pack(tokens, now), 0)
+            return wait
+        finally:
+            os.close(fd)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_retry_after=1.0):
+        """
+        Stop calling an upstream after failure_threshold consecutive
+        failures. After reset_timeout seconds one trial call is let through
+        (half-open): a success closes the circuit, a failure opens it again.
+
+        :param str name: The upstream name, used in logs and errors
+        :param int failure_threshold: The consecutive failures that open the circuit
+        :param float reset_timeout: The seconds the circuit stays open
+        :param float half_open_retry_after: The retry_after of calls rejected
+            while the trial call runs, so held messages do not bounce between
+            the broker and the consumer until it finishes
+        """
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._half_open_retry_after = min(half_open_retry_after, reset_timeout)
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def before_call(self):
+        """
+        Check whether a call may go through.
+
+        :raises CircuitOpenError: While the circuit is open, or while the
+            half-open trial call is still running
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+
+            if self._state == self.HALF_OPEN:
+                raise CircuitOpenError(self._name, self._half_open_retry_after)
+
+            retry_after = self._opened_at + self._reset_timeout - time.monotonic()
+            if retry_after <= 0:
+                LOGGER.info('Circuit for %s is half-open, trying one call', self._name)
+                self._state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(self._name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                LOGGER.info('Circuit for %s is closed again', self._name)
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                if self._state != self.OPEN:
+                    LOGGER.warning('Circuit for %s is open after %i failures', self._name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def get_rate_limiter(name):
+    """
+    Get the rate limiter of an upstream, configured by environment variables:
+
+    - <NAME>_RATE_LIMIT: the requests per second, 0 disables the limiter
+      (default from DEFAULT_RATE_LIMITS, else 0)
+    - <NAME>_RATE_BURST: the maximum burst (defaults to the rate)
+    - RATE_LIMIT_DIR: where the shared bucket files live (default: temp directory)
+
+    :param str name: The upstream name, e.g. 'weatherapi'
+    :rtype: TokenBucket | None
+    :return: The limiter, or None when the upstream is not limited
+    """
+    if name not in _rate_limiters:
+        with _registry_lock:
+            if name not in _rate_limiters:
+                prefix = name.upper()
+                rate = float(os.getenv(f'{prefix}_RATE_LIMIT', str(DEFAULT_RATE_LIMITS.get(name, 0))))
+                burst = float(os.getenv(f'{prefix}_RATE_BURST', '0')) or None
+                _rate_limiters[name] = TokenBucket(name, rate, burst, os.getenv('RATE_LIMIT_DIR')) if rate else None
+    return _rate_limiters[name]
+
+
+def get_circuit_breaker(name):
+    """
+    Get the circuit breaker of an upstream, configured by environment variables:
+
+    - CIRCUIT_FAILURE_THRESHOLD: consecutive failures that open the circuit (default 5)
+    - CIRCUIT_RESET_TIMEOUT: seconds the circuit stays open (default 30)
+    - CIRCUIT_HALF_OPEN_RETRY_AFTER: seconds calls wait while the half-open
+      trial call runs (default 1)
+
+    The breaker is per process: each process learns on its own that an
+    upstream is down, after at most CIRCUIT_FAILURE_THRESHOLD calls.
+
+    :param str name: The upstream name, e.g. 'weatherapi'
+    :rtype: CircuitBreaker
+    """
+    if name not in _circuit_breakers:
+        with _registry_lock:
+            if name not in _circuit_breakers:
+                _circuit_breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+                    reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30')),
+                    half_open_retry_after=float(os.getenv('CIRCUIT_HALF_OPEN_RETRY_AFTER', '1')))
+    return _circuit_breakers[name]
+
+
+def guarded_request(name, request):
+    """
+    Call an upstream through its circuit breaker and rate limiter.
+
+    429/5xx responses and any exception (connection errors, timeouts, but
+    also errors of the request callable itself) count as failures and are
+    raised; any other response closes the circuit and is returned. Every
+    outcome is recorded, so a half-open trial call always frees its slot.
+
+    :param str name: The upstream name, e.g. 'weatherapi'
+    :param callable request: Makes the request and returns the response
+    :rtype: requests.Response
+    :raises CircuitOpenError: Without calling the upstream, while its circuit is open
+    :raises UpstreamError: When the upstream answered 429 or 5xx
+    :raises requests.RequestException: When the request itself failed
+    """
+    breaker = get_circuit_breaker(name)
+    breaker.before_call()
+
+    limiter = get_rate_limiter(name)
+    try:
+        if limiter is not None:
+            limiter.acquire()
+        response = request()
+    except BaseException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code in RETRYABLE_STATUSES:
+        breaker.record_failure()
+        raise UpstreamError(name, response.status_code)
+
+    breaker.record_success()
+    return response
+
+
+async def aguarded_request(name, request):
+    """
+    The asyncio counterpart of guarded_request. A cancelled call counts as
+    a failure too, so a half-open trial call always frees its slot.
+
+    :param str name: The upstream name, e.g. 'weatherapi'
+    :param callable request: Returns an awaitable of the response
+    :raises CircuitOpenError: Without calling the upstream, while its circuit is open
+    :raises UpstreamError: When the upstream answered 429 or 5xx
+    """
+    breaker = get_circuit_breaker(name)
+    breaker.before_call()
+
+    limiter = get_rate_limiter(name)
+    try:
+        if limiter is not None:
+            await limiter.aacquire()
+        response = await request()
+    except BaseException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code in RETRYABLE_STATUSES:
+        breaker.record_failure()
+        raise UpstreamError(name, response.status_code)
+
+    breaker.record_success()
+    return response
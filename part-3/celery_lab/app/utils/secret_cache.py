@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SecretCache:
+    """
+    An in-process TTL cache for secrets.
+
+    Fresh entries are served from memory. Entries older than the TTL but
+    still inside the stale window are served as-is while a single background
+    thread reloads them. Concurrent misses for the same key wait for one load
+    instead of each hitting the backend.
+    """
+
+    def __init__(self, ttl, stale_ttl):
+        """
+        Initialize the SecretCache object.
+
+        :param float ttl: Seconds an entry is considered fresh
+        :param float stale_ttl: Seconds past the TTL an entry may still be
+            served while it is refreshed in the background
+        """
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Get the value for a key, loading it with the loader on a miss.
+
+        :param str key: The cache key
+        :param callable loader: A callable without arguments that returns the value
+        :return: The cached or freshly loaded value
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self._ttl:
+                return value
+            if age < self._ttl + self._stale_ttl:
+                self.__refresh_in_background(key, loader)
+                return value
+
+        return self.__load(key, loader)
+
+    def invalidate(self, key=None):
+        """
+        Drop a key from the cache, or every key if none is given.
+
+        :param str key: The cache key
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def __key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def __load(self, key, loader):
+        with self.__key_lock(key):
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self._ttl:
+                return entry[0]
+
+            value = loader()
+            self._entries[key] = (value, time.monotonic())
+            return value
+
+    def __refresh_in_background(self, key, loader):
+        lock = self.__key_lock(key)
+        if not lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self._entries[key] = (loader(), time.monotonic())
+            except Exception:
+                LOGGER.exception('Background refresh of %s failed, serving stale value', key)
+            finally:
+                lock.release()
+
+        threading.Thread(target=refresh, name=f'secret-refresh-{key}', daemon=True).start()
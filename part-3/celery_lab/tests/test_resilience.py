@@ -0,0 +1,65 @@
+import asyncio
+import types
+import unittest
+
+from app.utils import resilience
+from app.utils.resilience import CircuitBreaker, CircuitOpenError, aguarded_request, guarded_request
+
+
+class HalfOpenTrialTest(unittest.TestCase):
+    """
+    The half-open trial call must free its slot whatever way it ends, or
+    the circuit stays half-open and rejects every later call.
+    """
+
+    name = 'test-upstream'
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(self.name, failure_threshold=1, reset_timeout=0.0)
+        self.breaker.record_failure()
+        resilience._circuit_breakers[self.name] = self.breaker
+        resilience._rate_limiters[self.name] = None
+
+    def tearDown(self):
+        resilience._circuit_breakers.pop(self.name, None)
+        resilience._rate_limiters.pop(self.name, None)
+
+    def test_trial_call_raising_a_non_http_error_reopens_the_circuit(self):
+        def request():
+            raise ValueError('not JSON')
+
+        with self.assertRaises(ValueError):
+            guarded_request(self.name, request)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        response = guarded_request(self.name, lambda: types.SimpleNamespace(status_code=200))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_cancelled_async_trial_call_reopens_the_circuit(self):
+        async def request():
+            raise asyncio.CancelledError
+
+        async def response():
+            return types.SimpleNamespace(status_code=200)
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(aguarded_request(self.name, request))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.assertEqual(asyncio.run(aguarded_request(self.name, response)).status_code, 200)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_calls_during_the_trial_call_wait_half_open_retry_after(self):
+        breaker = CircuitBreaker(self.name, failure_threshold=1, reset_timeout=5.0, half_open_retry_after=1.0)
+        breaker.record_failure()
+        breaker._opened_at -= 5.0
+        breaker.before_call()
+
+        with self.assertRaises(CircuitOpenError) as raised:
+            breaker.before_call()
+        self.assertEqual(raised.exception.retry_after, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()